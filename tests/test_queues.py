@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_streaming'))
+
+from processing.queues import ReadyQueue  # noqa: E402
+
+
+def drain(queue):
+    items = []
+    while queue.qsize():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_drop_oldest_keeps_the_control_item_at_the_head():
+    queue = ReadyQueue(maxsize=3, policy='drop_oldest')
+    queue.offer(None, control=True)
+    queue.offer('img1')
+    queue.offer('img2')
+    assert queue.offer('img3')  # full, the oldest image is dropped instead of the control item
+    assert drain(queue) == [None, 'img2', 'img3']
+    assert queue.drops == 1
+
+
+def test_every_nth_keeps_the_control_item_at_the_head():
+    queue = ReadyQueue(maxsize=2, policy='every_nth')
+    queue.offer(None, control=True)
+    queue.offer('img1')
+    queue.offer('img2')
+    assert drain(queue) == [None, 'img2']
+
+
+def test_full_queue_of_control_items_drops_the_new_image():
+    queue = ReadyQueue(maxsize=2, policy='drop_oldest')
+    queue.offer(None, control=True)
+    queue.offer(None, control=True)
+    assert queue.offer('img')
+    assert not queue.offer(None, control=True)  # a control item is never dropped
+    assert drain(queue) == [None, None, None]
+
+
+def test_latest_overwrites_only_images():
+    queue = ReadyQueue(maxsize=2, policy='latest')
+    queue.offer('img1')
+    queue.offer(None, control=True)
+    queue.offer('img2')
+    queue.offer('img3')
+    assert drain(queue) == ['img1', None, 'img3']
@@ -0,0 +1,11 @@
+import sys
+
+from pathlib import Path
+
+if Path(__file__).parent.parent not in sys.path:
+    sys.path.append(str(Path(__file__).parent.parent))
+from benchmark.bench import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import os
+import cv2
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from loguru import logger
+from threading import Thread
+
+if Path(__file__).parent.parent not in sys.path:
+    sys.path.append(str(Path(__file__).parent.parent))
+from benchmark.synthetic import make_videos, synthetic_frame
+from processing.datasets import LoadBatchVideos
+from processing.manager import VideoManagers
+from processing.multiplexer import StreamMultiplexer
+from processing.simulation import simulated_source
+from processing.stream import Stream
+from processing.strategy import OnlyShowStrategy
+from processing.writer import VideoWriter
+from runner import StreamingRunner
+
+
+def latency_stats(seconds):
+    """ Latency summary in milliseconds """
+    if not len(seconds):
+        return {'mean': None, 'p50': None, 'p95': None, 'max': None}
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    return {
+        'mean': float(ms.mean()), 'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)),
+        'max': float(ms.max())
+    }
+
+
+def steady_result(name, params, stamps, latencies, frames_per_stamp=None, warmup=10):
+    """ Throughput between the stamps after warmup, so the start and the stop of the pipeline are not counted.
+
+    Args:
+        stamps: time.perf_counter() when each item (image or batch) was done.
+        latencies: Seconds of each item.
+        frames_per_stamp: Images of each item (1 by default).
+    """
+    frames_per_stamp = [1] * len(stamps) if frames_per_stamp is None else frames_per_stamp
+    warmup = min(warmup, max(0, len(stamps) - 2))
+    frames = int(sum(frames_per_stamp[warmup + 1:]))
+    seconds = stamps[-1] - stamps[warmup] if len(stamps) > 1 else 0.0
+    return {
+        'name': name, 'params': params, 'items': len(stamps), 'frames': int(sum(frames_per_stamp)),
+        'steady_frames': frames, 'steady_seconds': seconds, 'fps': frames / seconds if seconds > 0 else None,
+        'latency_ms': latency_stats(latencies[warmup:])
+    }
+
+
+def reset_managers():
+    # VideoManagers keeps the managers of the last create() in a class dictionary
+    VideoManagers._instances = {}
+
+
+def bench_video_stream(path, div_fps=1, save_dir='', warmup=10):
+    """ Read every image of VideoStream, latency is the wait of stream.read() """
+    define = copy.deepcopy(StreamingRunner.DEFINE_TEMPLATE)
+    stream, stream_thread = Stream.load('video', path, define, div_fps, save_dir, SYSDTFORMAT='%Y%m%d%H%M%S')
+    stream_thread.start()
+    stamps, latencies, frame = [], [], 0
+    while True:
+        start = time.perf_counter()
+        ret, frame, img, info = stream.read(frame)
+        if not ret or img is None:
+            break
+        stamps.append(time.perf_counter())
+        latencies.append(stamps[-1] - start)
+    stream.stop_signal = True
+    stream_thread.join()
+    return steady_result('video_stream', {'div_fps': div_fps}, stamps, latencies, warmup=warmup)
+
+
+def bench_load_batch_videos(paths, vid_batch=1, div_fps=1, save_dir='', stream_backend='thread', warmup=10):
+    """ Iterate LoadBatchVideos without writing videos, latency is the time to build each batch """
+    reset_managers()
+    defines = [copy.deepcopy(StreamingRunner.DEFINE_TEMPLATE) for _ in paths]
+    dataset = LoadBatchVideos(
+        paths, defines, vid_batch, div_fps, save_dir, vis_mode='none', stream_backend=stream_backend)
+    stamps, latencies, frames = [], [], []
+    it = iter(dataset)
+    while True:
+        start = time.perf_counter()
+        try:
+            imgs_info, imgs = next(it)
+        except StopIteration:
+            break
+        if imgs is None:
+            continue
+        stamps.append(time.perf_counter())
+        latencies.append(stamps[-1] - start)
+        frames.append(len(imgs_info))
+    for _, manager in dataset.video_managers.items():
+        manager.stop()
+        manager.stream_thread.join()
+    return steady_result('load_batch_videos', {
+        'streams': len(paths), 'vid_batch': vid_batch, 'div_fps': div_fps, 'stream_backend': stream_backend
+    }, stamps, latencies, frames_per_stamp=frames, warmup=warmup)
+
+
+def bench_video_writer(
+    save_dir, width=640, height=360, fps=30, frames=300, encoder='opencv', encoder_options=None, warmup=10
+):
+    """ Run VideoWriter.process_video over frames queued in advance, latency is the write of each image """
+    writer = VideoWriter(
+        save_dir, {'parent_folder': []}, 'bench_writer', fps, width, height, init_writer=True,
+        queue_maxsize=frames + 1, queue_policy='block', encoder=encoder, encoder_options=encoder_options
+    )
+    imgs = [synthetic_frame(width, height, i) for i in range(min(frames, 30))]
+    now = time.time()
+    for i in range(frames):
+        writer.put_frame({'write': imgs[i % len(imgs)]}, '', 'bench_writer', now, vis='w')
+    writer.put_frame(None, '', '', -1)
+    stamps, latencies = [], []
+    write_image = writer.write_image
+
+    def timed_write_image(*args, **kwargs):
+        start = time.perf_counter()
+        res = write_image(*args, **kwargs)
+        stamps.append(time.perf_counter())
+        latencies.append(stamps[-1] - start)
+        return res
+
+    writer.write_image = timed_write_image
+    thread = Thread(target=writer.process_video, args=(True, False), daemon=True)
+    thread.start()
+    thread.join()
+    return steady_result('video_writer', {
+        'width': width, 'height': height, 'fps': fps, 'encoder': encoder, 'encoder_options': encoder_options
+    }, stamps, latencies, warmup=warmup)
+
+
+def bench_live_streams(paths, cameras=16, seconds=10, save_dir='', warmup=10, **options):
+    """ Read simulated live cameras through VideoManagers and StreamMultiplexer.
+
+    Latency is the age of each image (from its grab) when it is read, recovery is the time from a disconnect to the
+    next connection of the camera.
+
+    Args:
+        options: Arguments of SimulatedCamera (jitter_ms, loss, freeze, stall, disconnect_sec, downtime_sec, ...).
+    """
+    reset_managers()
+    sources = {
+        i: simulated_source(paths[i % len(paths)], channel='cam%d' % i, seed=i, **options) for i in range(cameras)}
+    defines = {i: copy.deepcopy(StreamingRunner.DEFINE_TEMPLATE) for i in range(cameras)}
+    managers = VideoManagers.create(
+        sources, defines, 1, save_dir, 'none', video_sec=600, warn=False, SYSDTFORMAT='%Y%m%d%H%M%S',
+        YMDFORMAT='%Y%m%d000000'
+    )
+    for _, manager in managers.items():
+        manager.start()
+    frames = {k: 1 for k in managers.keys()}
+    multiplexer = StreamMultiplexer({k: m.stream for k, m in managers.items()})
+    stamps, latencies, deadline = [], [], time.time() + seconds
+    while time.time() < deadline:
+        for k, ret, frame, img, info in multiplexer.select(frames, timeout=min(1.0, max(0, deadline - time.time()))):
+            if ret and img is not None:
+                stamps.append(time.perf_counter())
+                latencies.append(time.time() - info['sec'])
+    stopped = sum([m.stream.stop_stream for m in managers.values()])
+    for _, manager in managers.items():
+        manager.stop()
+    # keep reading, a reconnecting stream waits for its queue to be empty
+    while any([m.stream_thread.is_alive() for m in managers.values()]):
+        multiplexer.select(frames, timeout=0.1)
+    multiplexer.close()
+    result = steady_result('live_streams', dict(
+        {'cameras': cameras, 'seconds': seconds}, **options), stamps, latencies, warmup=warmup)
+    cameras = [s['capture_factory'] for s in sources.values()]
+    result['stopped_streams'] = stopped
+    result['camera_stats'] = {k: sum([c.stats[k] for c in cameras]) for k in cameras[0].stats.keys()}
+    result['recovery_ms'] = latency_stats([r for c in cameras for r in c.recoveries])
+    return result
+
+
+class BenchShowStrategy(OnlyShowStrategy):
+    """ OnlyShowStrategy which records when each batch is processed """
+    stamps = []
+    frames = []
+
+    def pre_process_images(images_info, imgs, system_info):
+        BenchShowStrategy.stamps.append(time.perf_counter())
+        BenchShowStrategy.frames.append(len(images_info) if isinstance(images_info, list) else 1)
+        return tuple()
+
+
+def bench_streaming_runner(paths, vid_batch=1, div_fps=1, save_dir='', stream_backend='thread', warmup=10):
+    """ Run StreamingRunner with OnlyShowStrategy and write the videos, latency is the interval between batches """
+    reset_managers()
+    BenchShowStrategy.stamps, BenchShowStrategy.frames = [], []
+    runner = StreamingRunner(
+        paths, vid_batch=vid_batch, div_fps=div_fps, save_dir=save_dir, vis_mode='write', warnning=False,
+        processing_strategy=BenchShowStrategy, stream_backend=stream_backend
+    )
+    start = time.perf_counter()
+    runner.run()
+    wall = time.perf_counter() - start
+    stamps = BenchShowStrategy.stamps
+    result = steady_result('streaming_runner', {
+        'streams': len(paths), 'vid_batch': vid_batch, 'div_fps': div_fps, 'stream_backend': stream_backend
+    }, stamps, list(np.diff([start] + stamps)), frames_per_stamp=BenchShowStrategy.frames, warmup=warmup)
+    result['wall_seconds'] = wall
+    return result
+
+
+def parse_list(text):
+    return [int(x) for x in str(text).split(',') if len(x)]
+
+
+def environment():
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'opencv': cv2.__version__,
+        'numpy': np.__version__, 'cpu_count': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='video_streaming_bench_')
+    video_dir, save_dir = os.path.join(workdir, 'videos'), os.path.join(workdir, 'output')
+    cases = args.cases.split(',')
+    paths = make_videos(
+        video_dir, max(parse_list(args.streams)), width=args.width, height=args.height, fps=args.fps,
+        seconds=args.seconds, codec=args.codec, ext=args.ext
+    )
+    results = []
+    for _ in range(args.repeat):
+        if 'stream' in cases:
+            for div_fps in parse_list(args.div_fps):
+                results.append(bench_video_stream(paths[0], div_fps=div_fps, save_dir=save_dir, warmup=args.warmup))
+        if 'dataset' in cases:
+            for streams in parse_list(args.streams):
+                for vid_batch in parse_list(args.vid_batch):
+                    results.append(bench_load_batch_videos(
+                        paths[:streams], vid_batch=vid_batch, save_dir=save_dir, stream_backend=args.stream_backend,
+                        warmup=args.warmup
+                    ))
+        if 'writer' in cases:
+            results.append(bench_video_writer(
+                save_dir, width=args.width, height=args.height, fps=args.fps, frames=int(args.fps * args.seconds),
+                encoder=args.encoder, warmup=args.warmup
+            ))
+        if 'runner' in cases:
+            for streams in parse_list(args.streams):
+                results.append(bench_streaming_runner(
+                    paths[:streams], vid_batch=parse_list(args.vid_batch)[0], save_dir=save_dir,
+                    stream_backend=args.stream_backend, warmup=args.warmup
+                ))
+        if 'live' in cases:
+            results.append(bench_live_streams(
+                paths, cameras=args.cameras, seconds=args.live_seconds, save_dir=save_dir, warmup=args.warmup,
+                jitter_ms=args.jitter_ms, loss=args.loss, freeze=args.freeze, stall=args.stall,
+                disconnect_sec=args.disconnect_sec, downtime_sec=args.downtime_sec, connect_sec=args.connect_sec,
+                preload=args.preload
+            ))
+    report = {'environment': environment(), 'config': vars(args), 'results': results}
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Saved the benchmark results in %s' % args.output)
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the video streaming pipeline with synthetic videos.')
+    parser.add_argument(
+        '--cases', default='stream,dataset,writer,runner', help='Comma separated cases to run (also: live).')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--seconds', type=float, default=5, help='Length of each synthetic video.')
+    parser.add_argument('--codec', default='mp4v', help='FourCC of the synthetic videos.')
+    parser.add_argument('--ext', default='.mp4', help='Container of the synthetic videos.')
+    parser.add_argument('--streams', default='1,2,4', help='Stream counts of the dataset and runner cases.')
+    parser.add_argument('--vid-batch', default='1,2,4', help='vid_batch values of the dataset case (runner: first).')
+    parser.add_argument('--div-fps', default='1', help='div_fps values of the stream case.')
+    parser.add_argument('--stream-backend', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--encoder', default='opencv', choices=['opencv', 'ffmpeg'])
+    parser.add_argument('--cameras', type=int, default=16, help='Simulated cameras of the live case.')
+    parser.add_argument('--live-seconds', type=float, default=10, help='Duration of the live case.')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random delay of each simulated frame.')
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability of a frame which can not be decoded.')
+    parser.add_argument('--freeze', type=float, default=0.0, help='Probability of a frozen (repeated) frame.')
+    parser.add_argument('--stall', type=float, default=0.0, help='Probability of a stalled timestamp.')
+    parser.add_argument('--disconnect-sec', type=float, default=0, help='Mean seconds between disconnects.')
+    parser.add_argument('--downtime-sec', type=float, default=0.2, help='Seconds before a camera can reconnect.')
+    parser.add_argument('--connect-sec', type=float, default=0.1, help='Seconds of each connection attempt.')
+    parser.add_argument('--preload', type=int, default=300, help='Frames of the file kept in memory (0 decodes).')
+    parser.add_argument('--warmup', type=int, default=10, help='Items skipped before measuring the steady state.')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workdir', default='', help='Keep the videos here (a temporary folder by default).')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder.')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file of the results.')
+    parser.add_argument('--verbose', action='store_true', help='Show the logs of the library.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level='ERROR')
+    report = run(args)
+    for result in report['results']:
+        print('%-20s %-80s %10s fps  p50 %s ms' % (
+            result['name'], json.dumps(result['params']),
+            '%.1f' % result['fps'] if result['fps'] else '-',
+            '%.2f' % result['latency_ms']['p50'] if result['latency_ms']['p50'] is not None else '-'
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+import cv2
+import numpy as np
+
+from loguru import logger
+
+
+def synthetic_name(width, height, fps, seconds, codec='mp4v', ext='.mp4', index=0):
+    return 'synthetic_%dx%d_%gfps_%gs_%s_%d%s' % (width, height, fps, seconds, codec, index, ext)
+
+
+def synthetic_frame(width, height, i):
+    """ A gradient background with a moving box and the frame number, so consecutive frames are never the same """
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[..., 0] = (x + i * 3) % 256
+    img[..., 1] = (y + i * 5) % 256
+    img[..., 2] = (x[None] + y + i * 7) % 256 / 2
+    size = max(8, min(width, height) // 6)
+    left, top = (i * 7) % max(1, width - size), (i * 3) % max(1, height - size)
+    cv2.rectangle(img, (left, top), (left + size, top + size), (255, 255, 255), -1)
+    cv2.putText(img, str(i), (10, max(20, height // 8)), 0, max(0.5, height / 360), (0, 0, 0), 2, cv2.LINE_AA)
+    return img
+
+
+def make_video(path, width=640, height=360, fps=30, seconds=5, codec='mp4v'):
+    """ Write a synthetic video with OpenCV, an existing file is reused """
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (int(width), int(height)))
+    if not writer.isOpened():
+        raise ValueError("OpenCV can not write %s with the %s codec" % (path, codec))
+    for i in range(int(round(fps * seconds))):
+        writer.write(synthetic_frame(width, height, i))
+    writer.release()
+    logger.info('Created the synthetic video %s' % path)
+    return path
+
+
+def make_videos(folder, count, width=640, height=360, fps=30, seconds=5, codec='mp4v', ext='.mp4'):
+    """ Create count synthetic videos (each one is a separate file, so every stream decodes its own file) """
+    return [
+        make_video(
+            os.path.join(folder, synthetic_name(width, height, fps, seconds, codec=codec, ext=ext, index=i)),
+            width=width, height=height, fps=fps, seconds=seconds, codec=codec
+        ) for i in range(count)
+    ]
@@ -0,0 +1,148 @@
+import os
+import pickle
+import hashlib
+
+from loguru import logger
+
+from .metrics import METRICS
+
+
+class ResultCache:
+    """ On-disk cache of the strategy outputs of video files, keyed by the file identity, curframe and version.
+
+    The outputs of one file (and version) are kept in one append-only pickle file: each write appends a chunk of the
+    new outputs (every flush_every new outputs and by flush), and the chunks are loaded on the first lookup. The
+    outputs of a file are released from the memory by release(path) when its video ended. When the pickle files use
+    more than max_bytes, the least recently used ones are removed. Give it as result_cache of StreamingRunner (video
+    file sources).
+
+    Args:
+        folder: Folder of the pickle files.
+        version: Version of the strategy, change it when the outputs change.
+        max_bytes: Maximum size of the folder.
+        identity: 'stat' identifies a file by (path, size, mtime), 'content' by (size, hash of the first and last
+            MiB), which also hits for a copied or renamed file.
+        flush_every: Write the new outputs after this many outputs (0 only writes by flush).
+    """
+    HASH_BYTES = 1 << 20
+
+    def __init__(self, folder, version='', max_bytes=1 << 30, identity='stat', flush_every=1000):
+        if identity not in ('stat', 'content'):
+            raise ValueError("Invalid cache identity: %s" % identity)
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.version = version
+        self.max_bytes = max_bytes
+        self.identity = identity
+        self.flush_every = flush_every
+        self.keys = {}  # video path: pickle path
+        self.entries = {}  # pickle path: {curframe: output} of the videos in use
+        self.new = {}  # pickle path: {curframe: output} which are not written yet
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        METRICS.watch('result_cache_hits_total', self, lambda c: c.hits)
+        METRICS.watch('result_cache_misses_total', self, lambda c: c.misses)
+
+    def file_identity(self, path):
+        stat = os.stat(path)
+        if self.identity == 'stat':
+            return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            digest.update(f.read(ResultCache.HASH_BYTES))
+            if stat.st_size > ResultCache.HASH_BYTES:
+                f.seek(max(ResultCache.HASH_BYTES, stat.st_size - ResultCache.HASH_BYTES))
+                digest.update(f.read())
+        return stat.st_size, digest.hexdigest()
+
+    def entry_path(self, path):
+        if path not in self.keys:
+            key = repr((self.file_identity(path), self.version)).encode('utf-8')
+            self.keys[path] = os.path.join(self.folder, hashlib.sha1(key).hexdigest() + '.pkl')
+        return self.keys[path]
+
+    def _entry(self, path):
+        entry_path = self.entry_path(path)
+        entry = self.entries.get(entry_path)
+        if entry is None:
+            entry = self.entries[entry_path] = ResultCache._load(entry_path)
+        return entry
+
+    @staticmethod
+    def _load(entry_path):
+        """ Read the chunks of the pickle file, a broken tail (e.g. an interrupted write) is cut off """
+        entry = {}
+        if not os.path.exists(entry_path):
+            return entry
+        with open(entry_path, 'rb') as f:
+            end, size = 0, os.fstat(f.fileno()).st_size
+            while end < size:
+                try:
+                    entry.update(pickle.load(f))
+                except Exception as e:
+                    logger.warning('Cut the broken result cache %s at %d bytes: %s' % (entry_path, end, e))
+                    break
+                end = f.tell()
+        if end < size:
+            os.truncate(entry_path, end)
+        os.utime(entry_path)  # recently used
+        return entry
+
+    def get(self, path, curframe):
+        """ Return (hit, output) of the frame """
+        entry = self._entry(path)
+        if curframe in entry:
+            self.hits += 1
+            return True, entry[curframe]
+        self.misses += 1
+        return False, None
+
+    def put(self, path, curframe, output):
+        self._entry(path)[curframe] = output
+        self.new.setdefault(self.entry_path(path), {})[curframe] = output
+        self.pending += 1
+        if self.flush_every and self.pending >= self.flush_every:
+            self.flush()
+
+    @staticmethod
+    def _append(entry_path, chunk):
+        with open(entry_path, 'ab') as f:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def write(self):
+        """ Append the new outputs to their pickle files """
+        for entry_path, chunk in self.new.items():
+            ResultCache._append(entry_path, chunk)
+        self.new, self.pending = {}, 0
+
+    def release(self, path):
+        """ Write the new outputs of the video and drop its outputs from the memory, call it when the video ended """
+        entry_path = self.keys.pop(path, None)
+        if entry_path is None:
+            return
+        chunk = self.new.pop(entry_path, None)
+        if chunk:
+            ResultCache._append(entry_path, chunk)
+            self.pending -= len(chunk)
+        self.entries.pop(entry_path, None)
+
+    def flush(self):
+        """ Write the new outputs, then remove the least recently used files over max_bytes """
+        self.write()
+        self.evict()
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.folder, name))
+                files.append((stat.st_mtime, stat.st_size, os.path.join(self.folder, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, entry_path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(entry_path)
+            self.entries.pop(entry_path, None)
+            total -= size
+            logger.info('Evict the result cache %s' % entry_path)
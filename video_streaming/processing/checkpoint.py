@@ -0,0 +1,62 @@
+import os
+import json
+import time
+
+from loguru import logger
+
+
+class Checkpoint:
+    """ Progress of the video files of LoadBatchVideos in a json file, to resume a long job after a crash or restart.
+
+    Each video is recorded by its absolute path with its size and mtime (a changed file starts again) as
+    {'frame': last processed curframe, 'finished': bool, 'epoch': epoch state, 'segment': resumed times}. The file is
+    only written every interval_sec seconds (and at the end), so a killed job loses at most interval_sec of work.
+
+    Args:
+        path: Json file of the checkpoint.
+        interval_sec: Seconds between two writes.
+    """
+    def __init__(self, path, interval_sec=30.0):
+        self.path = path
+        self.interval_sec = interval_sec
+        self.saved_sec = time.time()
+        self.state = {'videos': {}}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.state = json.load(f)
+                logger.info('Resume from the checkpoint %s' % path)
+            except Exception as e:
+                logger.warning('Ignore the broken checkpoint %s: %s' % (path, e))
+
+    @staticmethod
+    def file_identity(path):
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path):
+        """ Record of the video (None if it is not recorded or the file changed) """
+        key, size, mtime = Checkpoint.file_identity(path)
+        record = self.state['videos'].get(key)
+        if record is None or record.get('size') != size or record.get('mtime') != mtime:
+            return None
+        return record
+
+    def finished(self, path):
+        record = self.get(path)
+        return record is not None and record.get('finished', False)
+
+    def update(self, path, **record):
+        key, size, mtime = Checkpoint.file_identity(path)
+        self.state['videos'].setdefault(key, {}).update(record, size=size, mtime=mtime)
+
+    def due(self):
+        return time.time() - self.saved_sec >= self.interval_sec
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+        self.saved_sec = time.time()
@@ -1,13 +1,46 @@
 import os
 import sys
 import glob
+import itertools
 import numpy as np
 
 from pathlib import Path
+from loguru import logger
 
 if Path(__file__).parent not in sys.path:
     sys.path.append(Path(__file__).parent)
 from .manager import VideoManagers
+from .multiplexer import AsyncStreamMultiplexer
+from .preprocess import BatchPreprocessor
+
+
+class BatchBuffer:
+    """ Preallocated batch array which is reused by every iteration of LoadBatchVideos.
+
+    Args:
+        capacity: Maximum images in one batch (vid_batch * number of streams).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = None
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def put(self, img):
+        """ Copy the image into the next free slot """
+        if self.data is None or self.data.shape[1:] != img.shape or self.data.dtype != img.dtype:
+            if self.count:
+                raise ValueError('All images in a batch must have the same shape, got %s and %s' % (
+                    str(self.data.shape[1:]), str(img.shape)))
+            self.data = np.empty((self.capacity, *img.shape), dtype=img.dtype)
+        self.data[self.count] = img
+        self.count += 1
+
+    def view(self):
+        """ Filled slots of the batch (None if every slot stayed empty). Overwritten by the next batch. """
+        return self.data[:self.count] if self.count else None
 
 
 class LoadBatchVideos:
@@ -19,8 +52,16 @@ class LoadBatchVideos:
     def __init__(
         self, path, define, vid_batch=1, div_fps=1, save_dir='', preproc=None, img_size=(640, 640), many_folder=False,
         video_sec=70, vis_mode='write', SYSDTFORMAT='%Y%m%d%H%M%S', YMDFORMAT='%Y%m%d000000', visualizer=None,
-        queue_maxsize=10, vid_queue_maxsize=200, close_prev_window=True
+        queue_maxsize=10, vid_queue_maxsize=200, close_prev_window=True, stream_backend='thread',
+        vid_queue_policy='drop_oldest', encoder='opencv', encoder_options=None, frame_store=None, checkpoint=None,
+        max_open=0
     ):
+        """
+        Args:
+            max_open: Keep at most max_open videos open (0 opens every video at once). A video is closed when it ends
+                and the next video is opened in its place, the video paths are also discovered lazily (sorted in each
+                folder, a glob pattern is in the file system order).
+        """
         # Initialize variables
         self.div_fps = div_fps
         self.preproc = preproc
@@ -28,17 +69,70 @@ class LoadBatchVideos:
         self.vid_batch = vid_batch
         self.end_title = '\n------------------------------------------------' + (
             '\n' + '%20s' * 2) % ('Infer Time', 'Total Time')
-        # get video paths
-        self.files, self.defines = LoadBatchVideos.build_videos_dict(path, define, many_folder=many_folder)
+        self.checkpoint = checkpoint
+        self.max_open = max_open
+        self.create_options = dict(
+            video_sec=video_sec, visualizer=visualizer, end_title=self.end_title, SYSDTFORMAT=SYSDTFORMAT,
+            YMDFORMAT=YMDFORMAT, queue_maxsize=queue_maxsize, vid_queue_maxsize=vid_queue_maxsize,
+            close_prev_window=close_prev_window, stream_backend=stream_backend, vid_queue_policy=vid_queue_policy,
+            encoder=encoder, encoder_options=encoder_options, frame_store=frame_store
+        )
+        self.save_dir = save_dir
+        self.vis_mode = vis_mode
+        # get video paths (lazily), the finished videos of the checkpoint are skipped
+        self.pending = (
+            (k, p, d) for k, p, d in LoadBatchVideos.iter_videos(
+                path, define, many_folder=many_folder, lazy=bool(self.max_open))
+            if not self._is_finished_video(p)
+        )
+        self.files, self.defines = {}, {}
+        self.resume_frames, self.segments, self.ended = {}, {}, set()
+        self.done_frames, self.reached = {}, set()  # last processed frames, videos read up to their last frame
+        self.stop_signals = {}
+        self.retired = []  # managers of the ended videos, joined at the end
+        self.frames = None  # set by __iter__
+        self.multiplexer = None
 
         # Create video managers
-        self.video_managers = VideoManagers.create(
-            self.files, self.defines, div_fps, save_dir, vis_mode, video_sec=video_sec, visualizer=visualizer,
-            end_title=self.end_title, SYSDTFORMAT=SYSDTFORMAT, YMDFORMAT=YMDFORMAT, queue_maxsize=queue_maxsize,
-            vid_queue_maxsize=vid_queue_maxsize, close_prev_window=close_prev_window
-        )
+        self.video_managers = {}
+        self._open_videos()
         self._init_from_manager()
 
+    @staticmethod
+    def _scan(folder, pattern):
+        """ Files of the folder pattern ('*.*', '*/*.*' or '*/img/*.*'), each folder is sorted on its own """
+        if not os.path.isdir(folder):
+            return
+        head, _, rest = pattern.partition('/')
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue  # hidden, as glob
+            if rest:
+                if entry.is_dir() and (head == '*' or entry.name == head):
+                    yield from LoadBatchVideos._scan(entry.path, rest)
+            elif entry.is_file() and '.' in entry.name:
+                yield entry.path
+
+    @staticmethod
+    def iter_video_paths(p, many_folder):
+        """ Yield the video paths one by one, like get_video_paths but only sorted in each folder """
+        if '*' in p:
+            files = glob.iglob(p, recursive=True)  # glob
+        elif os.path.isdir(p):
+            if many_folder:
+                files = LoadBatchVideos._scan(p, '*/img/*.*')  # dir
+            elif next(LoadBatchVideos._scan(p, '*.*'), None) is not None:
+                files = LoadBatchVideos._scan(p, '*.*')  # dir
+            else:
+                files = LoadBatchVideos._scan(p, '*/*.*')  # dir
+        elif os.path.isfile(p):
+            files = [p]  # files
+        else:
+            raise Exception(f'ERROR: {p} does not exist')
+        return (x for x in files if x.split('.')[-1].lower() in LoadBatchVideos.VID_FORMATS)
+
     @staticmethod
     def get_video_paths(p, many_folder):
         if '*' in p:
@@ -57,6 +151,18 @@ class LoadBatchVideos:
             raise Exception(f'ERROR: {p} does not exist')
         return [x for x in files if x.split('.')[-1].lower() in LoadBatchVideos.VID_FORMATS]
 
+    @staticmethod
+    def iter_videos(path, define, many_folder=False, lazy=False):
+        """ Yield (id, video path, video define) like build_videos_dict, lazy discovers the paths one by one
+            (iter_video_paths) instead of listing and sorting every video first (get_video_paths) """
+        if not isinstance(path, list):
+            p = str(Path(path).resolve())  # os-agnostic absolute path
+            paths = LoadBatchVideos.iter_video_paths if lazy else LoadBatchVideos.get_video_paths
+            for i, video_path in enumerate(paths(p, many_folder)):
+                yield i, video_path, define
+        else:
+            yield from ((i, p, define[i]) for i, p in enumerate(path))
+
     @staticmethod
     def build_videos_dict(path, define, many_folder=False):
         # process str
@@ -97,18 +203,130 @@ class LoadBatchVideos:
                 "dt": dt, "cur_sec": cur_sec, "cur_time": cur_time, "vid_time": vid_time,
                 "is_newepoch": self.video_managers[_in].epoch['n'],
                 "is_epochfinal": self.video_managers[_in].epoch['f'],
+                "info": info,
             })
         return imgs_info
 
     def _init_from_manager(self):
-        self.stop_signals = {k: False for k in self.video_managers.keys()}
         self.batch = len(self.video_managers)
+        self.batch_buffer = BatchBuffer((self.max_open or self.batch) * self.vid_batch)
 
         # setting the title for show
         self.title = ('\n' + '%15s' * 2) % ('Parrent Folder', 'Video')
         for _, m in self.video_managers.items():
             self.title += ('\n' + '%15s' * 2) % (os.path.join(*m.stream.video_define), m.vid_writer.start_time)
 
+    def _checkpointed(self, path):
+        """ Only the existing video files are recorded, VideoManagers.create skips the missing ones """
+        return self.checkpoint is not None and isinstance(path, str) and os.path.isfile(path)
+
+    def _is_finished_video(self, path):
+        if self._checkpointed(path) and self.checkpoint.finished(path):
+            logger.info('Skip the finished video %s' % path)
+            return True
+        return False
+
+    def _open_videos(self):
+        """ Open the pending videos until max_open videos are open (every video if max_open is 0) """
+        while True:
+            count = None if not self.max_open else self.max_open - len(self.video_managers)
+            if count is not None and count <= 0:
+                return
+            files, defines = {}, {}
+            for k, p, d in itertools.islice(self.pending, count):
+                files[k], defines[k] = p, d
+            if not len(files):
+                return
+            self.files.update(files)
+            self.defines.update(defines)
+            self.video_managers = VideoManagers.create(
+                files, defines, self.div_fps, self.save_dir, self.vis_mode, **self.create_options)
+            for k in files.keys():
+                if k in self.video_managers:
+                    self._init_video(k, self.video_managers[k])
+            if count is None:
+                return
+
+    def _init_video(self, k, manager):
+        """ Resume the video from the checkpoint, and start it if the iteration has started """
+        self.stop_signals[k] = False
+        self._resume(k, manager)
+        if self.frames is not None:
+            self.frames[k] = self.resume_frames.get(k, 0)
+            self.finalframes[k] = 0
+            manager.start()
+            if self.multiplexer is not None:
+                self.multiplexer.add(k, manager.stream)
+            logger.info('Open the video %s' % self.files[k])
+
+    def _retire_videos(self):
+        """ Close the ended videos (their last images were processed) and open the next videos in their place """
+        ended = [k for k in self.video_managers.keys() if self.stop_signals[k]]
+        for k in ended:
+            manager = self.video_managers.pop(k)
+            self._update_checkpoint(k, manager)
+            if self.multiplexer is not None:
+                self.multiplexer.remove(k)
+            manager.stop()
+            self.retired.append(manager)
+            for d in (
+                self.stop_signals, self.frames, self.finalframes, self.resume_frames, self.done_frames, self.segments,
+                self.files, self.defines
+            ):
+                d.pop(k, None)
+            self.ended.discard(k)
+            self.reached.discard(k)
+        self.close_retired(wait=False)
+        self._open_videos()
+        self.batch = len(self.video_managers)
+
+    def close_retired(self, wait=True):
+        """ Join the streams and the video writers of the closed videos, only the finished ones if not wait """
+        alive = []
+        for manager in self.retired:
+            threads = [t for t in (manager.stream_thread, manager.vid_thread) if t is not None]
+            if not wait and any(t.is_alive() for t in threads):
+                alive.append(manager)
+                continue
+            for t in threads:
+                t.join()
+        self.retired = alive
+
+    def _resume(self, k, manager):
+        """ Seek the partial video of the checkpoint to its last processed frame """
+        if not self._checkpointed(self.files[k]):
+            return
+        record = self.checkpoint.get(self.files[k])
+        self.segments[k] = 0 if record is None else record.get('segment', 0)
+        if record is None or not record.get('frame', 0):
+            return
+        # write the rest of the video into a new segment
+        self.segments[k] += 1
+        self.resume_frames[k] = record['frame']
+        manager.stream.seek(record['frame'])
+        manager.epoch = record.get('epoch', manager.epoch)
+        manager.vid_writer.name_suffix = '_resume%d' % self.segments[k]
+        logger.info('Resume the video %s from frame %d' % (self.files[k], record['frame']))
+
+    def save_checkpoint(self, force=False):
+        """ Record the processed frames (the batches which were taken before this call) """
+        if self.checkpoint is None or not (force or self.checkpoint.due()):
+            return
+        for k, manager in self.video_managers.items():
+            self._update_checkpoint(k, manager)
+        self.checkpoint.save()
+
+    def _update_checkpoint(self, k, manager):
+        """ Finish the video read up to its last frame, a stopped one (timeout, failed decode) resumes later """
+        if not self._checkpointed(self.files[k]):
+            return
+        if k in self.reached:
+            self.checkpoint.update(self.files[k], finished=True, segment=self.segments[k])
+        else:
+            self.checkpoint.update(
+                self.files[k], frame=self.done_frames.get(k, self.resume_frames.get(k, 0)), finished=False,
+                epoch=manager.epoch, segment=self.segments[k])
+
     def _update_epoch(self, k, manager):
         epoch = int(self.frames[k] / manager.stream.epochframes)
         if epoch > manager.epoch['e']:
@@ -128,44 +346,98 @@ class LoadBatchVideos:
         self.finalframes = {}
         # start video manager
         for k, video_manager in self.video_managers.items():
-            self.frames[k] = 0
+            self.frames[k] = self.resume_frames.get(k, 0)
             self.finalframes[k] = 0
             video_manager.start()
         return self
 
+    def _is_finished(self):
+        if self.max_open and self.frames is not None:
+            self._retire_videos()
+        return self.batch == 0 or all([self.stop_signals[k] for k in self.video_managers.keys()])
+
+    def _new_batch(self):
+        self.img0s, self.stream_info = [], []
+        self.batch_buffer.reset()
+
+    def _add_image(self, k, manager, ret, frame, img, info):
+        self.frames[k] = frame
+        if 'curframe' in info and info['curframe'] + manager.stream.div_fps > manager.stream.maxframes:
+            self.reached.add(k)
+        if not len(info):
+            self.stop_signals[k] = True
+            self.ended.add(k)
+        if not ret or img is None:
+            return
+        self.done_frames[k] = frame
+
+        # Concatenate Image Information
+        self.img0s.append(img)
+        if isinstance(self.preproc, BatchPreprocessor):
+            pass  # the whole batch is preprocessed in _end_batch
+        elif self.preproc is not None:
+            img, _ = self.preproc(img, None, self.img_size)
+            self.batch_buffer.put(img)
+        else:
+            self.batch_buffer.put(img)
+
+        # Calculate Epoch Frame
+        self._update_epoch(k, manager)
+
+        # Record Information
+        self.finalframes[k] = LoadBatchVideos.frame_counter(self.frames[k], manager.stream.epochframes)
+        self.stream_info.append((k, self.finalframes[k], *manager.stream.get_cur_info(info['sec']), info))
+
+    def _end_batch(self):
+        if isinstance(self.preproc, BatchPreprocessor):
+            imgs = self.preproc.process(self.img0s, self.img_size) if len(self.img0s) else None
+        else:
+            imgs = self.batch_buffer.view()
+        return self.transfer_images_info(self.stream_info, self.img0s), imgs
+
     def __next__(self):
-        if self.batch == 0 or all([self.stop_signals[k] for k in self.video_managers.keys()]):
+        if self._is_finished():
+            self.save_checkpoint(force=True)
+            self.close_retired()
             raise StopIteration
+        self.save_checkpoint()
 
-        img0s, imgs, stream_info = [], None, []
+        self._new_batch()
         for k, manager in self.video_managers.items():
             if not self.stop_signals[k]:
                 for _ in range(self.vid_batch):
                     # Load Image
-                    ret, self.frames[k], img, info = manager.stream.read(self.frames[k])
-                    if not len(info):
-                        self.stop_signals[k] = True
-                    if not ret or img is None:
-                        continue
-
-                    # Concatenate Image Information
-                    img0s.append(img)
-                    if self.preproc is not None:
-                        img, _ = self.preproc(img, None, self.img_size)
-                    if imgs is None:
-                        imgs = np.expand_dims(img, 0)
-                    else:
-                        imgs = np.concatenate((imgs, np.expand_dims(img, 0)), axis=0)
-
-                    # Calculate Epoch Frame
-                    self._update_epoch(k, manager)
-
-                    # Record Information
-                    self.finalframes[k] = LoadBatchVideos.frame_counter(self.frames[k], manager.stream.epochframes)
-                    stream_info.append((k, self.finalframes[k], *manager.stream.get_cur_info(info['sec']), info))
-        return self.transfer_images_info(stream_info, img0s), imgs
+                    self._add_image(k, manager, *manager.stream.read(self.frames[k]))
+        return self._end_batch()
+
+    def __aiter__(self):
+        """ Iterate in asyncio: async for imgs_info, imgs in dataset """
+        self.multiplexer = AsyncStreamMultiplexer({k: m.stream for k, m in self.video_managers.items()})
+        return self.__iter__()
+
+    async def __anext__(self):
+        if self._is_finished():
+            await self.aclose()
+            self.save_checkpoint(force=True)
+            self.close_retired()
+            raise StopAsyncIteration
+        self.save_checkpoint()
+
+        self._new_batch()
+        for k, manager in self.video_managers.items():
+            if not self.stop_signals[k]:
+                for _ in range(self.vid_batch):
+                    # Await Image
+                    self._add_image(k, manager, *(await self.multiplexer.read(k, self.frames[k])))
+        return self._end_batch()
+
+    async def aclose(self):
+        """ Stop waiting on the stream queues, await it if the async iteration stops early (break or exception) """
+        if self.multiplexer is not None:
+            self.multiplexer.close()
+            self.multiplexer = None
 
     def __len__(self):
         return int(np.ceil(max([
-            m.stream.maxframes for m in self.video_managers.values()]) / self.vid_batch / self.div_fps)
+            m.stream.maxframes / m.stream.div_fps for m in self.video_managers.values()]) / self.vid_batch)
         ) if len(self.video_managers.values()) else 0
@@ -0,0 +1,86 @@
+import cv2
+import shutil
+import subprocess
+import numpy as np
+
+from loguru import logger
+
+
+VIDFORMAT = {'.mp4': "mp4v"}
+
+
+class OpenCVEncoder:
+    """ Encode the video by cv2.VideoWriter """
+    def __init__(self, save_path, fps, width, height, vid_format='.mp4'):
+        self.writer = cv2.VideoWriter(
+            save_path, cv2.VideoWriter_fourcc(*VIDFORMAT[vid_format]), fps, (int(width), int(height)))
+
+    def write(self, img):
+        self.writer.write(img)
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegEncoder:
+    """ Stream raw BGR frames into a local ffmpeg process over stdin, the encoding runs in that process.
+
+    Args:
+        codec, preset, crf, threads: Passed to ffmpeg as -c:v, -preset, -crf and -threads (0 is automatic).
+        binary: Name or path of the ffmpeg executable.
+    """
+    def __init__(
+        self, save_path, fps, width, height, vid_format='.mp4', codec='libx264', preset='veryfast', crf=23, threads=0,
+        binary='ffmpeg'
+    ):
+        self.save_path = save_path
+        self.shape = (int(height), int(width), 3)
+        self.warned = False
+        self.closed = False  # the pipe broke, the next images are skipped
+        self.process = subprocess.Popen([
+            binary, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (int(width), int(height)), '-r', str(fps),
+            '-i', '-', '-an', '-c:v', codec, '-preset', preset, '-crf', str(crf), '-threads', str(threads),
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', save_path
+        ], stdin=subprocess.PIPE)
+
+    @staticmethod
+    def available(binary='ffmpeg'):
+        return shutil.which(binary) is not None
+
+    def write(self, img):
+        if self.closed:
+            return
+        # cv2.VideoWriter skips the image which has another size, do the same
+        if img.shape != self.shape:
+            if not self.warned:
+                self.warned = True
+                logger.warning('Skip the image in %s size for the %s video!!' % (str(img.shape), str(self.shape)))
+            return
+        try:
+            self.process.stdin.write(np.ascontiguousarray(img).data)
+        except (BrokenPipeError, ValueError):
+            self.closed = True
+            logger.error('The ffmpeg process of %s is closed, skip the rest of the video!!' % self.save_path)
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait():
+            logger.error('The ffmpeg process of %s exited with code %d' % (self.save_path, self.process.returncode))
+
+
+ENCODERS = {'opencv': OpenCVEncoder, 'ffmpeg': FFmpegEncoder}
+
+
+def create_encoder(encoder, save_path, fps, width, height, vid_format='.mp4', options=None):
+    """ Create the encoder by name, fall back to OpenCV if ffmpeg is not installed """
+    options = {} if options is None else options
+    if encoder == 'ffmpeg' and not FFmpegEncoder.available(options.get('binary', 'ffmpeg')):
+        logger.warning('ffmpeg is not found, use OpenCV to write %s' % save_path)
+        encoder, options = 'opencv', {}
+    if encoder not in ENCODERS:
+        raise ValueError("Invalid encoder: %s" % encoder)
+    return ENCODERS[encoder](save_path, fps, width, height, vid_format=vid_format, **options)
@@ -0,0 +1,148 @@
+import os
+import cv2
+import json
+import hashlib
+import threading
+import numpy as np
+
+from loguru import logger
+
+
+class FrameStore:
+    """ Decoded frames of video files in memory-mapped raw files, for many passes over the same videos.
+
+    The frames of one (file, div_fps, size) are kept in <key>.raw, one after another, with an index (<key>.idx.npy)
+    of the frame id, timestamp and byte offset of each frame, and <key>.json of the video information. The json file
+    is written last, so only complete stores are opened. When the stores use more than max_bytes, the least recently
+    used ones are removed. Give it as frame_store of StreamingRunner or LoadBatchVideos.
+
+    Args:
+        folder: Folder of the stores.
+        max_bytes: Maximum size of the folder.
+        size: (width, height) of the stored frames, the frames keep their size if None.
+        interpolation: Interpolation of the resize.
+    """
+    INDEX_DTYPE = np.dtype([('frame', np.int64), ('msec', np.float64), ('offset', np.int64)])
+
+    def __init__(self, folder, max_bytes=4 << 30, size=None, interpolation=cv2.INTER_AREA):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = None if size is None else (int(size[0]), int(size[1]))
+        self.interpolation = interpolation
+        self.lock = threading.Lock()
+
+    def key(self, source, div_fps):
+        stat = os.stat(source)
+        key = repr((os.path.abspath(source), stat.st_size, stat.st_mtime_ns, div_fps, self.size)).encode('utf-8')
+        return os.path.join(self.folder, hashlib.sha1(key).hexdigest())
+
+    def resize(self, img):
+        if self.size is None or (img.shape[1], img.shape[0]) == self.size:
+            return img
+        return cv2.resize(img, self.size, interpolation=self.interpolation)
+
+    def open(self, source, div_fps):
+        """ StoredFrames of the video (None if it is not stored) """
+        key = self.key(source, div_fps)
+        with self.lock:
+            if not os.path.exists(key + '.json'):
+                return None
+            try:
+                frames = StoredFrames(key)
+            except Exception as e:
+                logger.warning('Ignore the broken frame store %s: %s' % (key, e))
+                return None
+            os.utime(key + '.json')  # recently used
+        return frames
+
+    def writer(self, source, div_fps, info, expected_bytes=0):
+        """ FrameStoreWriter of the video (None if the video is larger than max_bytes) """
+        if expected_bytes > self.max_bytes:
+            logger.warning('Do not store %s, %d bytes is over the frame store limit.' % (source, expected_bytes))
+            return None
+        return FrameStoreWriter(self, self.key(source, div_fps), info)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used stores until the folder is under max_bytes """
+        stores, total = {}, 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.startswith('.') or name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            key = os.path.join(self.folder, name.split('.')[0])
+            stat = os.stat(path)
+            total += stat.st_size
+            mtime, size = stores.get(key, (None, 0))
+            stores[key] = (stat.st_mtime if name.endswith('.json') else mtime, size + stat.st_size)
+        for key, (_, size) in sorted(stores.items(), key=lambda s: s[1][0] or 0):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for ext in ('.json', '.idx.npy', '.raw'):
+                if os.path.exists(key + ext):
+                    os.remove(key + ext)
+            total -= size
+            logger.info('Evict the frame store %s' % key)
+
+
+class StoredFrames:
+    """ Memory-mapped frames of a store, frames[i] is a zero-copy view (copy-on-write, the file is never changed) """
+    def __init__(self, key):
+        with open(key + '.json') as f:
+            self.info = json.load(f)
+        self.index = np.load(key + '.idx.npy')
+        self.frames = np.memmap(
+            key + '.raw', dtype=np.uint8, mode='c', shape=(len(self.index), self.info['height'], self.info['width'], 3))
+
+    def __len__(self):
+        return len(self.index)
+
+
+class FrameStoreWriter:
+    """ Append the frames of a video to a store, commit() makes it visible, discard() removes it """
+    def __init__(self, store, key, info):
+        self.store = store
+        self.key = key
+        self.info = dict(info)
+        self.index = []
+        self.offset = 0
+        self.shape = None
+        self.file = open(key + '.raw.tmp', 'wb')
+
+    def write(self, frame, msec, img):
+        if self.file is None:
+            return
+        if self.shape is None:
+            self.shape = img.shape
+        if img.shape != self.shape or img.dtype != np.uint8:
+            logger.warning('Do not store %s, the frames change their shape.' % self.key)
+            return self.discard()
+        self.file.write(np.ascontiguousarray(img).data)
+        self.index.append((frame, msec, self.offset))
+        self.offset += img.nbytes
+
+    def commit(self):
+        if self.file is None:
+            return
+        if not len(self.index):
+            return self.discard()
+        self.file.close()
+        self.file = None
+        self.info.update({'height': self.shape[0], 'width': self.shape[1], 'count': len(self.index)})
+        with self.store.lock:
+            os.replace(self.key + '.raw.tmp', self.key + '.raw')
+            np.save(self.key + '.idx.npy', np.array(self.index, dtype=FrameStore.INDEX_DTYPE))
+            with open(self.key + '.json.tmp', 'w') as f:
+                json.dump(self.info, f)
+            os.replace(self.key + '.json.tmp', self.key + '.json')
+            self.store.evict(keep=self.key)
+        logger.info('Stored %d frames in %s' % (len(self.index), self.key))
+
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.key + '.raw.tmp')
@@ -5,6 +5,8 @@ from threading import Thread
 
 from .stream import Stream
 from .writer import VideoWriter
+from .queues import ReadyQueue
+from .metrics import METRICS
 
 
 class VideoManagers:
@@ -12,7 +14,7 @@ class VideoManagers:
 
     def __init__(
         self, mode, vis_mode, stream, stream_thread, save_dir, visualizer, end_title, vid_queue_maxsize=200,
-        close_prev_window=True
+        close_prev_window=True, vid_queue_policy='drop_oldest', encoder='opencv', encoder_options=None
     ):
         # update parameters
         self.mode = mode
@@ -27,8 +29,11 @@ class VideoManagers:
             queue_maxsize=vid_queue_maxsize, visualizer=self.visualizer,
             keepdate=False if mode == 'webcam' else stream.video_define['start_time'] == 'videoname',
             keepname=False if mode == 'webcam' else stream.video_define['start_time'] == 'videoname',
-            close_prev_window=close_prev_window
+            close_prev_window=close_prev_window, queue_policy=vid_queue_policy, encoder=encoder,
+            encoder_options=encoder_options, metrics_labels=stream.metrics_labels,
+            copy_frames=getattr(stream, 'ring', None) is not None
         )
+        self.watch_metrics()
         # vis mode thread
         if self.vis_mode == 'write':
             self.vid_thread = Thread(target=self.vid_writer.process_video, args=(True, False), daemon=True)
@@ -41,6 +46,20 @@ class VideoManagers:
             logger.warning("Current vis_mode is %s, will ignore to build video writer !!" % self.vis_mode)
         self.epoch = {'e': 0, 'n': True, 'f': False}
 
+    def watch_metrics(self):
+        """ Read the fps, the queue depths and the queue drops of this manager when the metrics are rendered """
+        labels = self.stream.metrics_labels
+        METRICS.watch('stream_fps', self.stream, lambda s: s.fps, labels)
+        METRICS.watch('stream_infer_fps', self.stream, lambda s: s.infer_fps, labels)
+        METRICS.watch('stream_queue_depth', self.stream, lambda s: s.queue.qsize(), labels)
+        METRICS.watch('writer_queue_depth', self.vid_writer, lambda w: w.queue.qsize(), labels)
+        if isinstance(self.stream.queue, ReadyQueue):
+            METRICS.watch('stream_queue_drops_total', self.stream, lambda s: s.queue.drops, labels)
+        if isinstance(self.vid_writer.queue, ReadyQueue):
+            METRICS.watch('writer_queue_drops_total', self.vid_writer, lambda w: w.queue.drops, labels)
+        if getattr(self.stream, 'ring', None) is not None:
+            METRICS.watch('stream_ring_fallbacks_total', self.stream, lambda s: s.ring.fallbacks.value, labels)
+
     @staticmethod
     def get_mode(video_path):
         mode = 'video' if isinstance(video_path, list) or isinstance(video_path, str) else 'webcam'
@@ -65,12 +84,20 @@ class VideoManagers:
     def create(
         cls, video_sources: dict, video_defines: dict, div_fps, save_dir, vis_mode, video_sec=0,
         visualizer=None, end_title='', SYSDTFORMAT='', YMDFORMAT='', warn=True, queue_maxsize=10, vid_queue_maxsize=200,
-        close_prev_window=True
+        close_prev_window=True, stream_backend='thread', queue_policy='drop_oldest', vid_queue_policy='drop_oldest',
+        encoder='opencv', encoder_options=None, frame_store=None
     ):
         """
         Args:
             video_sources: {id: "video path", ...}
             video_defines: {id: {"parent_folder": [None, ...], "start_time": "current"}}
+            stream_backend: 'thread' decodes in the current process, 'process' decodes video files in worker processes.
+            queue_policy: Policy of the live stream queues when they are full (see ReadyQueue).
+            vid_queue_policy: Policy of the video writer queues when they are full.
+            encoder: 'opencv' (cv2.VideoWriter) or 'ffmpeg' (pipe frames into a ffmpeg process).
+            encoder_options: Options of the ffmpeg encoder, for example {"codec": "libx264", "preset": "veryfast",
+                "crf": 23, "threads": 0}.
+            frame_store: FrameStore of the decoded frames of video files (see StoredVideoStream).
         """
         initialized_video_source = set()
         for k, video_source in video_sources.items():
@@ -85,7 +112,8 @@ class VideoManagers:
             # load stream
             stream, stream_thread = Stream.load(
                 mode, video_source, video_define, div_fps, save_dir, video_sec=video_sec,
-                SYSDTFORMAT=SYSDTFORMAT, YMDFORMAT=YMDFORMAT, warn=warn, queue_maxsize=queue_maxsize
+                SYSDTFORMAT=SYSDTFORMAT, YMDFORMAT=YMDFORMAT, warn=warn, queue_maxsize=queue_maxsize,
+                backend=stream_backend, queue_policy=queue_policy, frame_store=frame_store
             )
             initialized_video_source.add(str(video_source))
 
@@ -96,7 +124,8 @@ class VideoManagers:
             # get manager
             cls._instances[k] = VideoManagers(
                 mode, vis_mode, stream, stream_thread, save_dir, visualizer, end_title,
-                vid_queue_maxsize=vid_queue_maxsize, close_prev_window=close_prev_window
+                vid_queue_maxsize=vid_queue_maxsize, close_prev_window=close_prev_window,
+                vid_queue_policy=vid_queue_policy, encoder=encoder, encoder_options=encoder_options
             )
         return cls._instances
 
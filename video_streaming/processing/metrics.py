@@ -0,0 +1,178 @@
+import time
+import weakref
+import threading
+
+from loguru import logger
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricsRegistry:
+    """ Counters and summaries of the streaming pipeline, rendered in the Prometheus text format.
+
+    The instrumented code checks METRICS.enabled before measuring anything, so a disabled registry only costs that
+    attribute lookup. Every thread updates its own shard (no lock), the shards are summed when the metrics are read.
+    Queue depths and drop counts are not updated in the hot path, they are read from the watched objects when the
+    metrics are rendered.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []
+        self.helps = {}
+        self.watches = []
+        self.server = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def describe(self, name, kind, help_text):
+        """ Set the type ('counter', 'gauge' or 'summary') and the help text of the metric """
+        self.helps[name] = (kind, help_text)
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        """ Add value to the counter, labels is a tuple of (label, value) """
+        shard, key = self._shard(), (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels=(), value=0.0):
+        """ Add an observation (for example a latency in seconds) to the summary """
+        shard, key = self._shard(), (name, labels)
+        summary = shard.get(key)
+        if summary is None:
+            summary = shard[key] = [0, 0.0]
+        summary[0] += 1
+        summary[1] += value
+
+    def watch(self, name, obj, getter, labels=()):
+        """ Read getter(obj) when the metrics are rendered, until obj is garbage collected.
+            getter can return a number, or {labels: number} for many series. """
+        with self.lock:
+            self.watches.append((name, weakref.ref(obj), getter, labels))
+
+    def collect(self):
+        """ Return {name: {labels: value}}, the value of a summary is [count, sum] """
+        with self.lock:
+            shards, watches = list(self.shards), list(self.watches)
+        metrics = {}
+        for shard in shards:
+            for (name, labels), value in shard.copy().items():
+                series = metrics.setdefault(name, {})
+                if isinstance(value, list):
+                    prev = series.get(labels, [0, 0.0])
+                    series[labels] = [prev[0] + value[0], prev[1] + value[1]]
+                else:
+                    series[labels] = series.get(labels, 0) + value
+        alive = []
+        for watch in watches:
+            name, ref, getter, labels = watch
+            obj = ref()
+            if obj is None:
+                continue
+            alive.append(watch)
+            try:
+                value = getter(obj)
+            except Exception:
+                continue
+            series = metrics.setdefault(name, {})
+            for sub_labels, sub_value in (value.items() if isinstance(value, dict) else [((), value)]):
+                series[labels + tuple(sub_labels)] = sub_value
+        with self.lock:
+            self.watches = alive + [w for w in self.watches if w not in watches]
+        return metrics
+
+    @staticmethod
+    def _labels(labels):
+        if not len(labels):
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')) for k, v in labels)
+
+    def render(self):
+        """ Metrics in the Prometheus text exposition format """
+        lines = []
+        for name, series in sorted(self.collect().items()):
+            kind, help_text = self.helps.get(name, ('gauge', ''))
+            if help_text:
+                lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in series.items():
+                if isinstance(value, list):
+                    lines.append('%s_count%s %d' % (name, self._labels(labels), value[0]))
+                    lines.append('%s_sum%s %r' % (name, self._labels(labels), float(value[1])))
+                else:
+                    lines.append('%s%s %r' % (name, self._labels(labels), float(value)))
+        lines.append('streaming_metrics_scrape_timestamp_seconds %r' % time.time())
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108, host='127.0.0.1'):
+        """ Enable the metrics and serve them at http://host:port/metrics in a daemon thread """
+        if self.server is not None:
+            return self.server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.enable()
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info('Serve the streaming metrics in http://%s:%d/metrics' % (host, self.server.server_address[1]))
+        return self.server
+
+    def stop_serving(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+METRICS = MetricsRegistry()
+for _name, _kind, _help in (
+    ('stream_frames_total', 'counter', 'Images captured by the stream (after div_fps).'),
+    ('stream_decode_seconds', 'summary', 'Time to grab and decode an image of the stream.'),
+    ('stream_reconnects_total', 'counter', 'Reconnections of the live stream (set_camera).'),
+    ('stream_fps', 'gauge', 'FPS of the source.'),
+    ('stream_infer_fps', 'gauge', 'Expected FPS of the images after div_fps.'),
+    ('stream_queue_depth', 'gauge', 'Images waiting in the stream queue.'),
+    ('stream_queue_drops_total', 'counter', 'Images dropped by the stream queue policy.'),
+    ('stream_ring_fallbacks_total', 'counter', 'Images pickled by the process backend because no ring slot was free.'),
+    ('writer_frames_total', 'counter', 'Images written to the videos.'),
+    ('writer_encode_seconds', 'summary', 'Time to encode an image into the video.'),
+    ('writer_frame_age_seconds', 'summary', 'Now minus the image timestamp when it is written (live streams).'),
+    ('writer_queue_depth', 'gauge', 'Images waiting in the video writer queue.'),
+    ('writer_queue_drops_total', 'counter', 'Images dropped by the video writer queue policy.'),
+    ('visualizer_queue_depth', 'gauge', 'Images waiting in the visualizer window queues.'),
+    ('visualizer_queue_drops_total', 'counter', 'Images dropped by the visualizer queue policy.'),
+    ('runner_frames_total', 'counter', 'Images processed by the runner.'),
+    ('runner_process_seconds', 'summary', 'Time of the runner to process a batch of images.'),
+    ('runner_skipped_frames_total', 'counter', 'Unchanged images which reused the last output (skip_unchanged).'),
+    ('result_cache_hits_total', 'counter', 'Images of the video files which reused a cached output.'),
+    ('result_cache_misses_total', 'counter', 'Images of the video files which were not in the result cache.'),
+    ('motion_gate_frames_total', 'counter', 'Images checked by the motion gate, by result (motion, keepalive, gated).'),
+):
+    METRICS.describe(_name, _kind, _help)
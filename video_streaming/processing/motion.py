@@ -0,0 +1,81 @@
+import cv2
+import time
+import numpy as np
+
+from loguru import logger
+
+from .stream import thumbnail
+from .metrics import METRICS
+
+
+class MotionGate:
+    """ Forward only the images with motion to the processing strategy, plus a keep-alive image every keepalive_sec.
+
+    Each stream keeps a running-average background of its small grayscale images (cv2.accumulateWeighted). A pixel
+    is moving when it differs from the background by more than pixel_diff, and the activity of the image is the
+    fraction of moving pixels. Give it as motion_gate of StreamingRunner.
+
+    Args:
+        threshold: Minimum activity (0 ~ 1) to forward the image.
+        pixel_diff: Minimum absolute difference (0 ~ 255) between a pixel and the background to be moving.
+        alpha: Learning rate of the background.
+        keepalive_sec: Forward one image every keepalive_sec seconds of the stream without motion (0 disables).
+        width: Width of the grayscale images.
+    """
+    RESULTS = ('motion', 'keepalive', 'gated')
+
+    def __init__(self, threshold=0.01, pixel_diff=25, alpha=0.05, keepalive_sec=5.0, width=96):
+        self.threshold = threshold
+        self.pixel_diff = pixel_diff
+        self.alpha = alpha
+        self.keepalive_sec = keepalive_sec
+        self.width = width
+        self.backgrounds = {}  # stream id: float32 background
+        self.forward_sec = {}  # stream id: second of the last forwarded image
+        self.stats = {}  # stream id: {'frames', 'motion', 'keepalive', 'gated', 'activity'}
+        METRICS.watch('motion_gate_frames_total', self, lambda g: {
+            (('stream', k), ('result', r)): s[r] for k, s in list(g.stats.items()) for r in MotionGate.RESULTS})
+
+    def check(self, key, img, sec=None):
+        """ Update the background of the stream, return (forward, activity) of the image """
+        sec = time.time() if sec is None else sec
+        gray = thumbnail(img, self.width).astype(np.float32)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = {'frames': 0, 'motion': 0, 'keepalive': 0, 'gated': 0, 'activity': 0.0}
+        stats['frames'] += 1
+
+        # activity from the background, the first image of the stream is always forwarded
+        background = self.backgrounds.get(key)
+        if background is None or background.shape != gray.shape:
+            self.backgrounds[key], activity = gray, 1.0
+        else:
+            activity = float(np.count_nonzero(cv2.absdiff(gray, background) > self.pixel_diff)) / gray.size
+            cv2.accumulateWeighted(gray, background, self.alpha)
+        stats['activity'] += activity
+
+        if activity >= self.threshold:
+            result = 'motion'
+        elif self.keepalive_sec and sec - self.forward_sec.get(key, -np.inf) >= self.keepalive_sec:
+            result = 'keepalive'
+        else:
+            result = 'gated'
+        stats[result] += 1
+        if result != 'gated':
+            self.forward_sec[key] = sec
+        return result != 'gated', activity
+
+    def reset(self, key=None):
+        """ Forget the background of the stream (every stream if key is None) """
+        for d in (self.backgrounds, self.forward_sec):
+            if key is None:
+                d.clear()
+            else:
+                d.pop(key, None)
+
+    def report(self):
+        """ Log the statistics of each stream """
+        for key, s in self.stats.items():
+            logger.info('Motion gate %s: %d frames, %d motion, %d keep-alive, %d gated (%.1f%%), mean activity %.4f' % (
+                key, s['frames'], s['motion'], s['keepalive'], s['gated'], 100 * s['gated'] / max(1, s['frames']),
+                s['activity'] / max(1, s['frames'])))
@@ -0,0 +1,177 @@
+import time
+import asyncio
+
+from threading import Event
+
+from .queues import ReadyQueue
+
+
+class StreamMultiplexer:
+    """ Wait on the queues of many streams together and only read the streams which are ready.
+
+    A stream which has nothing in its queue for longer than its own read_timeout is still read (with timeout=0),
+    so the stream handles the timeout as it does in a blocking read.
+
+    Args:
+        streams: {id: stream}
+        ready: The event which is set by the stream queues (threading.Event by default).
+    """
+    POLL_SEC = 0.01  # wait step if a queue can not notify (e.g. the multiprocessing queue of the process backend)
+
+    def __init__(self, streams, ready=None):
+        self.streams = streams
+        self.ready = Event() if ready is None else ready
+        self.notify = all(isinstance(s.queue, ReadyQueue) for s in self.streams.values())
+        for s in self.streams.values():
+            if isinstance(s.queue, ReadyQueue):
+                s.queue.listeners.append(self.ready)
+        now = time.time()
+        self.last_sec = {k: now for k in self.streams.keys()}
+        self.keys = list(self.streams.keys())
+        self.offset = 0  # first stream to read, rotated when a read is limited
+
+    def close(self):
+        for s in self.streams.values():
+            if isinstance(s.queue, ReadyQueue) and self.ready in s.queue.listeners:
+                s.queue.listeners.remove(self.ready)
+
+    def add(self, k, stream):
+        """ Wait on a new stream too """
+        self.streams[k] = stream
+        if isinstance(stream.queue, ReadyQueue):
+            stream.queue.listeners.append(self.ready)
+        else:
+            self.notify = False
+        self.last_sec[k] = time.time()
+        self.keys.append(k)
+
+    def remove(self, k):
+        """ Stop waiting on the stream k """
+        stream = self.streams.pop(k)
+        if isinstance(stream.queue, ReadyQueue) and self.ready in stream.queue.listeners:
+            stream.queue.listeners.remove(self.ready)
+        self.last_sec.pop(k, None)
+        self.keys.remove(k)
+        self.offset = 0
+        self.notify = all(isinstance(s.queue, ReadyQueue) for s in self.streams.values())
+
+    def _read_ready(self, frames, limit=None):
+        outputs, now = [], time.time()
+        for i in range(len(self.keys)):
+            k = self.keys[(self.offset + i) % len(self.keys)]
+            stream = self.streams[k]
+            if stream.queue.empty() and now - self.last_sec[k] <= stream.read_timeout:
+                continue
+            self.last_sec[k] = now
+            ret, frames[k], img, info = stream.read(frames[k], timeout=0)
+            outputs.append((k, ret, frames[k], img, info))
+            if limit is not None and len(outputs) >= limit:
+                self.offset = (self.offset + i + 1) % len(self.keys)
+                break
+        return outputs
+
+    def _wait(self, remaining):
+        self.ready.wait(remaining if self.notify else min(remaining, StreamMultiplexer.POLL_SEC))
+
+    def select(self, frames, timeout=1.0, limit=None):
+        """ Read every stream which is ready, wait at most timeout seconds for the first one.
+
+        Args:
+            frames: {id: frame} of the last read, updated in place.
+            limit: Maximum images to read.
+
+        Returns:
+            A list of (id, ret, frame, img, info), empty if no stream was ready before the deadline.
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.ready.clear()
+            outputs = self._read_ready(frames, limit=limit)
+            remaining = deadline - time.time()
+            if outputs or remaining <= 0:
+                return outputs
+            self._wait(remaining)
+
+    def collect(self, frames, max_batch, max_wait, timeout=1.0):
+        """ Dynamic batch: after the first image, keep reading the ready streams until there are max_batch images or
+            max_wait seconds passed. A stream can give more than one image to the batch. """
+        outputs = self.select(frames, timeout=timeout, limit=max_batch)
+        deadline = time.time() + max_wait
+        while outputs and len(outputs) < max_batch:
+            self.ready.clear()
+            outputs += self._read_ready(frames, limit=max_batch - len(outputs))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if len(outputs) < max_batch:
+                self._wait(remaining)
+        return outputs
+
+
+class AsyncReadyEvent:
+    """ asyncio.Event which can be set from the stream threads, create it in the running event loop """
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def set(self):
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # the event loop is closed, do not break the stream thread
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class AsyncStreamMultiplexer(StreamMultiplexer):
+    """ StreamMultiplexer which awaits the stream queues instead of blocking the event loop """
+    def __init__(self, streams):
+        super().__init__(streams, ready=AsyncReadyEvent())
+
+    async def _wait(self, remaining):
+        await self.ready.wait(remaining if self.notify else min(remaining, StreamMultiplexer.POLL_SEC))
+
+    async def select(self, frames, timeout=1.0, limit=None):
+        """ Same as StreamMultiplexer.select """
+        deadline = time.time() + timeout
+        while True:
+            self.ready.clear()
+            outputs = self._read_ready(frames, limit=limit)
+            remaining = deadline - time.time()
+            if outputs or remaining <= 0:
+                return outputs
+            await self._wait(remaining)
+
+    async def collect(self, frames, max_batch, max_wait, timeout=1.0):
+        """ Same as StreamMultiplexer.collect """
+        outputs = await self.select(frames, timeout=timeout, limit=max_batch)
+        deadline = time.time() + max_wait
+        while outputs and len(outputs) < max_batch:
+            self.ready.clear()
+            outputs += self._read_ready(frames, limit=max_batch - len(outputs))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if len(outputs) < max_batch:
+                await self._wait(remaining)
+        return outputs
+
+    async def read(self, k, frame):
+        """ Await stream k like a blocking stream.read(frame), but without blocking the event loop """
+        stream = self.streams[k]
+        deadline = time.time() + stream.read_timeout
+        while True:
+            self.ready.clear()
+            remaining = deadline - time.time()
+            if not stream.queue.empty() or remaining <= 0:
+                self.last_sec[k] = time.time()
+                return stream.read(frame, timeout=0)
+            await self._wait(remaining)
@@ -0,0 +1,119 @@
+import cv2
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatchPreprocessor:
+    """ Letterbox a batch of BGR images into one preallocated array, the images are processed by a thread pool (cv2
+        and numpy release the GIL). Give it as preproc of LoadBatchVideos or StreamingRunner.
+
+    Each image is resized by ratio = min(height / h, width / w), placed at the top-left (or the center) and the rest is
+    filled by pad_value, the same as the YOLOX preproc. The output of a pixel x is (x * scale - mean) / std.
+
+    Args:
+        img_size: (height, width) of the output, the img_size of the dataset is used if None.
+        dtype: np.float32 (or np.float16) to normalize, np.uint8 only letterboxes.
+        rgb: Convert BGR to RGB.
+        chw: Transpose to (channel, height, width).
+        scale: Multiplier of the pixels, for example 1 / 255.
+        mean, std: Per channel (after rgb) mean and std in the scaled unit.
+        pad_value: Pixel value of the padding (before normalization).
+        center: Center the image instead of placing it at the top-left.
+        workers: Threads of the pool (1 processes in the calling thread).
+    """
+    def __init__(
+        self, img_size=None, dtype=np.float32, rgb=False, chw=True, scale=1.0, mean=None, std=None, pad_value=114,
+        center=False, interpolation=cv2.INTER_LINEAR, workers=4
+    ):
+        self.img_size = img_size
+        self.dtype = np.dtype(dtype)
+        self.rgb = rgb
+        self.chw = chw
+        self.center = center
+        self.interpolation = interpolation
+        self.workers = workers
+        self.normalize = self.dtype.kind == 'f'
+        if not self.normalize and (scale != 1.0 or mean is not None or std is not None):
+            raise ValueError('Normalization needs a float dtype, got %s' % self.dtype)
+        mean = np.zeros(3) if mean is None else np.asarray(mean, dtype=np.float64)
+        std = np.ones(3) if std is None else np.asarray(std, dtype=np.float64)
+        # output = x * alpha + beta
+        self.alpha = (scale / std).astype(np.float32)
+        self.beta = (-mean / std).astype(np.float32)
+        self.pad = (pad_value * self.alpha + self.beta) if self.normalize else np.full(3, pad_value)
+        self.pad = self.pad.astype(self.dtype)
+        if self.chw:
+            self.alpha, self.beta = self.alpha[:, None, None], self.beta[:, None, None]
+            self.pad = self.pad[:, None, None]
+        self.pool = None
+        self.data = None
+        self.ratios = []
+        self.offsets = []  # (top, left) of each image in the output
+
+    def _allocate(self, count, img_size):
+        h, w = img_size
+        shape = (3, h, w) if self.chw else (h, w, 3)
+        if self.data is None or self.data.shape[1:] != shape or len(self.data) < count:
+            self.data = np.empty((max(count, 0 if self.data is None else len(self.data)), *shape), dtype=self.dtype)
+        self.ratios, self.offsets = [None] * count, [None] * count
+
+    def _fill(self, out, rows, cols):
+        if self.chw:
+            out[:, rows, cols] = self.pad
+        else:
+            out[rows, cols] = self.pad.reshape(3)
+
+    def _process(self, i, img):
+        th, tw = self.data.shape[2:] if self.chw else self.data.shape[1:3]
+        h, w = img.shape[:2]
+        r = min(th / h, tw / w)
+        nh, nw = min(th, int(h * r)), min(tw, int(w * r))
+        if (nh, nw) != (h, w):
+            img = cv2.resize(img, (nw, nh), interpolation=self.interpolation)
+        if self.rgb:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        top, left = ((th - nh) // 2, (tw - nw) // 2) if self.center else (0, 0)
+        out = self.data[i]
+
+        # padding
+        self._fill(out, slice(0, top), slice(None))
+        self._fill(out, slice(top + nh, None), slice(None))
+        self._fill(out, slice(top, top + nh), slice(0, left))
+        self._fill(out, slice(top, top + nh), slice(left + nw, None))
+
+        # image
+        region = out[:, top:top + nh, left:left + nw] if self.chw else out[top:top + nh, left:left + nw]
+        src = img.transpose(2, 0, 1) if self.chw else img
+        if self.normalize:
+            np.multiply(src, self.alpha if self.chw else self.alpha.reshape(3), out=region, casting='unsafe')
+            region += self.beta if self.chw else self.beta.reshape(3)
+        else:
+            region[...] = src
+        self.ratios[i], self.offsets[i] = r, (top, left)
+
+    def process(self, imgs, img_size=None):
+        """ Letterbox the images into the batch array.
+
+        Returns:
+            Array of (len(imgs), ...) which is overwritten by the next call.
+        """
+        img_size = self.img_size if self.img_size is not None else img_size
+        self._allocate(len(imgs), img_size)
+        if self.workers > 1 and len(imgs) > 1:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            list(self.pool.map(self._process, range(len(imgs)), imgs))
+        else:
+            for i, img in enumerate(imgs):
+                self._process(i, img)
+        return self.data[:len(imgs)]
+
+    def __call__(self, img, res=None, input_size=None):
+        """ Preprocess one image like the per-image preproc(img, None, img_size) """
+        return self.process([img], input_size)[0].copy(), self.ratios[0]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
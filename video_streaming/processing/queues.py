@@ -0,0 +1,129 @@
+from queue import Queue
+from threading import Condition
+from collections import deque
+
+
+QUEUE_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'latest', 'every_nth')
+
+
+class ReadyQueue(Queue):
+    """ Queue which sets the events of its listeners on every put, so a consumer can wait on many queues at once.
+        Producers can also wait until the consumer drained the queue.
+
+    offer() puts an image by the queue policy when the queue is full:
+        - 'block': wait for the consumer (lossless).
+        - 'drop_oldest': drop the oldest image.
+        - 'drop_newest': drop the new image.
+        - 'latest': keep only the latest image, a new image overwrites the image at the tail of the queue.
+        - 'every_nth': keep every KEEP_EVERY-th new image (drop the oldest image for it) while the queue stays full.
+    Control items (stop signals) are never dropped by the policy, a full queue of control items drops the new image.
+    self.drops counts the dropped items.
+    """
+    KEEP_EVERY = 2
+
+    def __init__(self, maxsize=0, policy='drop_oldest'):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Invalid queue policy: %s" % policy)
+        super().__init__(maxsize)
+        self.policy = policy
+        self.listeners = []
+        self.drained = Condition(self.mutex)
+        self.drops = 0
+        self.pressure = 0
+        self.tail_is_image = False
+        self.controls = deque()  # whether each queued item is a control item
+        self.putting_control = False
+
+    def _put(self, item):
+        super()._put(item)
+        self.controls.append(self.putting_control)
+        for event in self.listeners:
+            event.set()
+
+    def _get(self):
+        item = super()._get()
+        self.controls.popleft()
+        if not self._qsize():
+            self.drained.notify_all()
+        return item
+
+    def _full(self):
+        return 0 < self.maxsize <= self._qsize()
+
+    def _append(self, item, control=False):
+        self.putting_control = control
+        try:
+            self._put(item)
+        finally:
+            self.putting_control = False
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _drop_oldest_image(self):
+        """ Remove the oldest image (the control items are kept), return False if there is no image """
+        for i, control in enumerate(self.controls):
+            if not control:
+                del self.queue[i]
+                del self.controls[i]
+                if not self._qsize():
+                    self.drained.notify_all()
+                return True
+        return False
+
+    def clear(self):
+        with self.mutex:
+            self.queue.clear()
+            self.controls.clear()
+            self.drained.notify_all()
+            self.not_full.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """ Wait until the queue is empty, return False on timeout """
+        with self.drained:
+            return self.drained.wait_for(lambda: not self._qsize(), timeout)
+
+    def offer(self, item, control=False):
+        """ Put the item by the queue policy, return True if an item was dropped """
+        if self.policy == 'block':
+            self.put(item)
+            return False
+
+        dropped = False
+        with self.mutex:
+            if self.policy == 'latest' and not control and self._qsize() and self.tail_is_image:
+                # overwrite the image which has not been read yet
+                self.queue[-1] = item
+                for event in self.listeners:
+                    event.set()
+                dropped = True
+            else:
+                full = self.policy != 'latest' and self._full()
+                if full and not control and (
+                    self.policy == 'drop_newest' or (self.policy == 'every_nth' and self.pressure % self.KEEP_EVERY)
+                ):
+                    self.pressure += 1
+                    self.drops += 1
+                    return True
+                if full:
+                    # drop the oldest image, a control item is kept even if the queue only has control items
+                    dropped = self._drop_oldest_image()
+                    if not dropped and not control:
+                        self.drops += 1
+                        return True
+                self.pressure = self.pressure + 1 if full else 0
+                self._append(item, control=control)
+                self.tail_is_image = not control
+            self.drops += dropped
+        return dropped
+
+
+def offer(queue, item, control=False):
+    """ Put the item to a ReadyQueue by its policy, a plain queue drops the oldest item when it is full """
+    if isinstance(queue, ReadyQueue):
+        return queue.offer(item, control=control)
+    dropped = False
+    if queue.full():
+        queue.get()
+        dropped = True
+    queue.put(item)
+    return dropped
@@ -0,0 +1,62 @@
+import queue
+import weakref
+import numpy as np
+
+from multiprocessing import shared_memory
+
+
+class FrameRing:
+    """ Fixed-size frame slots in shared memory.
+
+    The producer decodes into a free slot and only puts the slot index to the stream queue. The consumer wraps the
+    slot as a numpy view, and the slot is released back to the producer once every reference to that view is gone.
+
+    Args:
+        ctx: The multiprocessing context of the producer process.
+        slots: Number of slots.
+        shape: Shape of one frame, for example (height, width, 3).
+    """
+    def __init__(self, ctx, slots, shape, dtype=np.uint8):
+        self.slots = slots
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.slots * self.slot_bytes))
+        self.linked = True
+        self.fallbacks = ctx.Value('q', 0)  # images which were pickled because every slot was in use
+        self.free = ctx.Queue()
+        for i in range(self.slots):
+            self.free.put(i)
+
+    def acquire(self, timeout=None):
+        """ Get a free slot index (None if there is no free slot in timeout seconds) """
+        try:
+            return self.free.get(block=timeout is None or timeout > 0, timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def array(self, slot):
+        """ Numpy array of the slot, used by the producer to decode in place """
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def is_slot(self, slot, img):
+        return img is not None and img.ctypes.data == self.array(slot).ctypes.data
+
+    def view(self, slot):
+        """ Zero-copy image of the slot, the slot is released when the image is garbage collected """
+        img = self.array(slot)
+        weakref.finalize(img, self.release, slot)
+        return img
+
+    def unlink(self):
+        """ Remove the shared memory name, the memory is freed after every process unmaps it """
+        if not self.linked:
+            return
+        self.linked = False
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
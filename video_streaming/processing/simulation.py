@@ -0,0 +1,229 @@
+import cv2
+import time
+import random
+import threading
+
+from loguru import logger
+
+
+class SimulatedCamera:
+    """ Capture factory of a simulated live camera, it plays a local video at real-time pace in a loop.
+
+    Give it to LiveVideoStream as stream_info['capture_factory'] (see simulated_source). Every reconnection of the
+    stream calls the factory again, so the camera keeps the disconnect state and the recovery statistics.
+
+    Args:
+        path: Local video file.
+        fps: Playback FPS (the FPS of the file by default).
+        jitter_ms: Random delay (0 ~ jitter_ms) added to each frame.
+        loss: Probability that a frame can not be decoded (retrieve fails, the frame counter still moves).
+        freeze: Probability that the camera repeats the frame (the frame counter does not move).
+        stall: Probability that the timestamp (CAP_PROP_POS_MSEC) does not move.
+        disconnect_sec: Mean seconds between disconnects (0 never disconnects).
+        downtime_sec: Seconds before the camera can be connected again after a disconnect.
+        connect_sec: Seconds of each connection attempt (a RTSP connection is not instant, even when it fails).
+        preload: Keep the first preload frames in memory and play them instead of decoding the file (0 decodes), the
+            frames are shared by the cameras of the same file.
+        seed: Seed of the random injections.
+    """
+    _frames = {}
+    _frames_lock = threading.Lock()
+
+    def __init__(
+        self, path, fps=None, jitter_ms=0, loss=0.0, freeze=0.0, stall=0.0, disconnect_sec=0, downtime_sec=1.0,
+        connect_sec=0.0, preload=0, seed=None
+    ):
+        self.path = path
+        self.fps = fps
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.freeze = freeze
+        self.stall = stall
+        self.disconnect_sec = disconnect_sec
+        self.downtime_sec = downtime_sec
+        self.connect_sec = connect_sec
+        self.preload = preload
+        self.random = random.Random(seed)
+        # state
+        self.down_until = 0.0
+        self.disconnected_sec = None
+        self.stats = {'connects': 0, 'refused': 0, 'frames': 0, 'loss': 0, 'freeze': 0, 'stall': 0, 'disconnects': 0}
+        self.recoveries = []  # seconds from each disconnect to the next connection
+
+    def __call__(self, url=''):
+        if self.connect_sec:
+            time.sleep(self.connect_sec)
+        now = time.time()
+        if now < self.down_until:
+            self.stats['refused'] += 1
+            return SimulatedCapture(self, opened=False)
+        if self.disconnected_sec is not None:
+            self.recoveries.append(now - self.disconnected_sec)
+            self.disconnected_sec = None
+        self.stats['connects'] += 1
+        return SimulatedCapture(self)
+
+    def frames(self):
+        """ Preloaded frames of the file (None if preload is 0) """
+        if not self.preload:
+            return None
+        key = (self.path, self.preload)
+        with SimulatedCamera._frames_lock:
+            if key not in SimulatedCamera._frames:
+                capture, frames = cv2.VideoCapture(self.path), []
+                while len(frames) < self.preload:
+                    ret, img = capture.read()
+                    if not ret:
+                        break
+                    frames.append(img)
+                capture.release()
+                SimulatedCamera._frames[key] = frames
+            return SimulatedCamera._frames[key]
+
+    def file_fps(self):
+        if getattr(self, '_file_fps', None) is None:
+            capture = cv2.VideoCapture(self.path)
+            self._file_fps = capture.get(cv2.CAP_PROP_FPS)
+            capture.release()
+        return self._file_fps
+
+    def next_disconnect(self):
+        if not self.disconnect_sec:
+            return None
+        return time.time() + self.random.expovariate(1.0 / self.disconnect_sec)
+
+    def disconnect(self):
+        now = time.time()
+        self.stats['disconnects'] += 1
+        self.disconnected_sec = now
+        self.down_until = now + self.downtime_sec
+
+
+class SimulatedCapture:
+    """ cv2.VideoCapture-like capture of a SimulatedCamera """
+    def __init__(self, camera, opened=True):
+        self.camera = camera
+        self.opened = opened
+        self.capture = None
+        self.frames = None
+        self.img = None
+        self.index = 0  # position in the file
+        self.pos_frames = 0
+        self.pos_msec = 0.0
+        self.width = self.height = 0.0
+        if not opened:
+            return
+        self.frames = camera.frames()
+        if self.frames:
+            self.fps = camera.fps or camera.file_fps()
+            self.height, self.width = self.frames[0].shape[:2]
+        else:
+            self.capture = cv2.VideoCapture(camera.path)
+            self.opened = self.capture.isOpened()
+            self.fps = camera.fps or self.capture.get(cv2.CAP_PROP_FPS)
+            self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)
+            self.height = self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        if self.opened and self.fps <= 0:
+            logger.warning('Bad FPS of the simulated camera %s' % camera.path)
+            self.fps = 30.0
+        self.start_sec = time.time()
+        self.disconnect_sec = camera.next_disconnect()
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps if self.opened else 0.0
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.pos_frames)
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.pos_msec
+        return 0.0
+
+    def _decode(self):
+        if self.frames is not None:
+            img = self.frames[self.index % len(self.frames)]
+        else:
+            ret, img = self.capture.read()
+            if not ret:
+                # play the file in a loop
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, img = self.capture.read()
+                if not ret:
+                    return None
+        self.index += 1
+        return img
+
+    def grab(self):
+        """ Wait for the next frame at real-time pace, then inject the errors """
+        if not self.opened:
+            return False
+        camera = self.camera
+        # real-time pace with jitter
+        due = self.start_sec + (self.pos_frames + 1) / self.fps
+        if camera.jitter_ms:
+            due += camera.random.uniform(0, camera.jitter_ms) / 1000
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if self.disconnect_sec is not None and time.time() >= self.disconnect_sec:
+            camera.disconnect()
+            self.release()
+            return False
+        # frozen frame: the camera sends the same frame again
+        if self.img is not None and camera.freeze and camera.random.random() < camera.freeze:
+            camera.stats['freeze'] += 1
+            self.start_sec += 1 / self.fps
+            return True
+        self.pos_frames += 1
+        if camera.stall and camera.random.random() < camera.stall:
+            camera.stats['stall'] += 1
+        else:
+            self.pos_msec = self.pos_frames / self.fps * 1000
+        img = self._decode()
+        if img is None:
+            self.release()
+            return False
+        camera.stats['frames'] += 1
+        if camera.loss and camera.random.random() < camera.loss:
+            camera.stats['loss'] += 1
+            self.img = None
+        else:
+            self.img = img
+        return True
+
+    def retrieve(self):
+        if self.img is None:
+            return False, None
+        return True, self.img.copy()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+
+def simulated_source(path, group='sim', channel='cam0', **options):
+    """ Stream information of a simulated camera, use it as a dictionary source of VideoManagers or StreamingRunner.
+
+    Args:
+        options: Arguments of SimulatedCamera.
+    """
+    return {
+        'ip': 'simulated', 'port': ' ', 'username': ' ', 'password': ' ', 'stream_name': channel, 'group': group,
+        'channel': channel, 'capture_factory': SimulatedCamera(path, **options)
+    }
@@ -1,15 +1,92 @@
 import os
+import re
 import cv2
 import sys
 import time
+import numpy as np
+import multiprocessing as mp
 
-from queue import Queue
+from queue import Full
 from pathlib import Path
 from loguru import logger
 from threading import Thread
 from datetime import datetime
 from abc import ABC, abstractmethod
 
+from .metrics import METRICS
+from .queues import ReadyQueue, offer
+
+
+class TimeFormatter:
+    """ Format timestamps by (day format, time formats...), the strings only change once per second (or per day for
+        the day format), so they are cached on the integer second and on the day. The day format is only cached on the
+        day if it has date directives only. """
+    ROUND_UP_SEC = 0.9999995  # datetime.fromtimestamp rounds to microseconds, which may give the next second
+    DATE_DIRECTIVES = set('aAbBhdejmyYCgGuUVwWxDF%')
+
+    def __init__(self, day_format, *formats):
+        self.formats = (day_format, ) + formats
+        self.cacheable = not any('%f' in f for f in self.formats)
+        self.day_cacheable = all(
+            d in TimeFormatter.DATE_DIRECTIVES for d in re.findall(r'%[-_0^#]?([a-zA-Z%])', day_format))
+        self.second = None
+        self.day = None
+        self.day_text = None
+        self.texts = None
+
+    def format(self, cur_second):
+        """ Return (day text, *time texts) of the timestamp """
+        second = int(cur_second // 1)
+        if not self.cacheable or cur_second - second >= TimeFormatter.ROUND_UP_SEC:
+            dt = datetime.fromtimestamp(cur_second)
+            return tuple(dt.strftime(f) for f in self.formats)
+        if second != self.second:
+            dt = datetime.fromtimestamp(second)
+            day = (dt.year, dt.month, dt.day)
+            if day != self.day or not self.day_cacheable:
+                self.day, self.day_text = day, dt.strftime(self.formats[0])
+            self.second = second
+            self.texts = (self.day_text, ) + tuple(dt.strftime(f) for f in self.formats[1:])
+        return self.texts
+
+
+def thumbnail(img, width):
+    """ Grayscale image of the width, pick pixels of 4x the size first, then average them (much cheaper than
+        INTER_AREA on the full image) """
+    h, w = img.shape[:2]
+    size = (width, max(1, round(h * width / w)))
+    thumb = cv2.resize(img, (size[0] * 4, size[1] * 4), interpolation=cv2.INTER_NEAREST)
+    thumb = cv2.resize(thumb, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY) if thumb.ndim == 3 else thumb
+
+
+class FrameChange:
+    """ Cheap change signal of the consecutive images of a stream, written to the image information:
+        info['repeat'] is True if the image is exactly the previous one (for example the previous image which is given
+        again after a packet loss), info['diff'] is the mean absolute difference (0 ~ 255) of the downsampled grayscale
+        images (None for the first image). """
+    def __init__(self, width=64):
+        self.width = width
+        self.prev = None
+        self.prev_thumb = None
+
+    def update(self, img, info):
+        """ Compare the image to the previous one and write 'repeat' and 'diff' to info """
+        if img is None:
+            return info
+        if img is self.prev:
+            info['repeat'], info['diff'] = True, 0.0
+            return info
+        thumb, repeat, diff = thumbnail(img, self.width), False, None
+        if self.prev_thumb is not None and thumb.shape == self.prev_thumb.shape:
+            diff = cv2.norm(thumb, self.prev_thumb, cv2.NORM_L1) / thumb.size
+            # the previous image may share the buffer of the new one (e.g. a reused frame ring slot)
+            repeat = diff == 0 and img.shape == self.prev.shape and img.ctypes.data != self.prev.ctypes.data and \
+                np.array_equal(img, self.prev)
+        self.prev, self.prev_thumb = img, thumb
+        info['repeat'], info['diff'] = repeat, diff
+        return info
+
 
 class Stream(ABC):
     VIDOE_DTFORMAT = '%Y/%m/%d %H:%M:%S'
@@ -17,21 +94,37 @@ class Stream(ABC):
     @classmethod
     def load(
         cls, mode, video_path, define, div_fps, save_dir, video_sec=0, SYSDTFORMAT='', YMDFORMAT='', warn=True,
-        queue_maxsize=10
+        queue_maxsize=10, backend='thread', queue_policy='drop_oldest', frame_store=None
     ):
+        """ Create the stream and its producer. backend='process' decodes video files in a worker process.
+            queue_policy is used by the queue of live streams (see ReadyQueue). Video files are read from frame_store
+            (a FrameStore) if it is given. """
         cls.SYSDTFORMAT = SYSDTFORMAT
         cls.YMDFORMAT = YMDFORMAT
         if cls != Stream:
             raise NotImplementedError("Subclasses must implement from_dict()")
-        if mode == "video":
+        if backend not in ('thread', 'process'):
+            raise ValueError("Invalid stream backend: %s" % backend)
+        if mode == "video" and frame_store is not None:
+            stream = StoredVideoStream(
+                frame_store, video_path, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT,
+                queue_maxsize=queue_maxsize)
+            stream_thread = Thread(target=stream.run, daemon=True)
+        elif mode == "video" and backend == 'process':
+            stream = ProcessVideoStream(
+                video_path, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT, queue_maxsize=queue_maxsize)
+            stream_thread = stream.process
+        elif mode == "video":
             stream = VideoStream(
                 video_path, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT, queue_maxsize=queue_maxsize)
             # stream_thread = None
             stream_thread = Thread(target=stream.run, daemon=True)
         elif mode == "webcam":
+            if backend == 'process' and warn:
+                logger.warning("Process backend only supports video files, %s will use thread." % video_path)
             stream = LiveVideoStream(
                 video_path, define, video_sec, div_fps, save_dir, SYSDTFORMAT, YMDFORMAT, queue_maxsize=queue_maxsize,
-                warn=warn
+                warn=warn, queue_policy=queue_policy
             )
             stream_thread = Thread(target=stream.run, daemon=True)
         else:
@@ -48,9 +141,10 @@ class Stream(ABC):
 
     def get_cur_info(self, cur_second):
         """ Get the time & sec in cur frame (second) """
-        cur_date_time = datetime.fromtimestamp(cur_second).strftime(self.YMDFORMAT)
-        cur_time = datetime.fromtimestamp(cur_second).strftime(self.SYSDTFORMAT)
-        vid_time = datetime.fromtimestamp(cur_second).strftime(Stream.VIDOE_DTFORMAT)
+        formatter = getattr(self, 'time_formatter', None)
+        if formatter is None or formatter.formats != (self.YMDFORMAT, self.SYSDTFORMAT, Stream.VIDOE_DTFORMAT):
+            formatter = self.time_formatter = TimeFormatter(self.YMDFORMAT, self.SYSDTFORMAT, Stream.VIDOE_DTFORMAT)
+        cur_date_time, cur_time, vid_time = formatter.format(cur_second)
         return cur_date_time, cur_second, cur_time, vid_time
 
     @abstractmethod
@@ -69,18 +163,23 @@ class Stream(ABC):
         pass
 
     @abstractmethod
-    def read(self, frame):
-        """ Read new image from stream """
+    def read(self, frame, timeout=None):
+        """ Read new image from stream (wait read_timeout seconds if timeout is None) """
         pass
 
 
 class VideoStream(Stream):
-    def __init__(self, source, define, div_fps=1, save_dir='', SYSDTFORMAT='%Y%m%d%H%M%S', queue_maxsize=100):
+    read_timeout = 1
+
+    def __init__(
+        self, source, define, div_fps=1, save_dir='', SYSDTFORMAT='%Y%m%d%H%M%S', queue=None, queue_maxsize=100
+    ):
         # process parent folder
         for i in range(len(define['parent_folder'])):
             if define['parent_folder'][-(i + 1)] is None:
                 define['parent_folder'][-(i + 1)] = source.split(os.sep)[-(i + 2)]
         self.video_define = define
+        self.metrics_labels = (('stream', str(source)), )
 
         self.save_dir = save_dir
         self.SYSDTFORMAT = SYSDTFORMAT
@@ -102,6 +201,7 @@ class VideoStream(Stream):
         self.stop_stream = False
         self.stop_signal = False
         self.cur_frame_id = 0
+        self.frame_change = FrameChange()
         self.capture = cv2.VideoCapture(source)
         self.fps = self.capture.get(cv2.CAP_PROP_FPS)
         self.width = self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)  # float
@@ -109,7 +209,13 @@ class VideoStream(Stream):
         self.maxframes = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
         self.epochframes = self.maxframes
         self.infer_fps = self.fps // self.div_fps
-        self.queue = Queue(maxsize=queue_maxsize)  # self.queue_maxsize) if queue is None else queue
+        self.queue = ReadyQueue(maxsize=queue_maxsize) if queue is None else queue
+        # sampling mode: one frame every sample_sec seconds (replace div_fps), seek if the gap is over seek_sec
+        self.sample_sec = self.video_define.get('sample_sec', 0) if self.fps > 0 else 0
+        self.seek_frames = round(self.video_define.get('seek_sec', 2.0) * self.fps)
+        if self.sample_sec:
+            self.div_fps = max(1, round(self.sample_sec * self.fps))
+            self.infer_fps = self.fps / self.div_fps
 
     def stop(self, stop_stream=True):
         self.stop_stream = stop_stream
@@ -120,32 +226,62 @@ class VideoStream(Stream):
 
     def run_stop(self, frame):
         if frame >= self.maxframes:
-            t = 0
-            while self.queue.full() and t < 10:  # 1 seconds
-                time.sleep(0.1)
-                t += 1
-
-            if self.queue.full():
+            try:
+                self.queue.put((False, -1, None, {}), timeout=1)
+            except Full:
                 self.queue.get()
                 logger.warning('Drop the streaming image !!')
-            self.queue.put((False, -1, None, {}))
+                self.queue.put((False, -1, None, {}))
             return True
         return False
 
+    def seek(self, frame):
+        """ Continue after the frame (before the stream starts) """
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame)
+        self.cur_frame_id = frame
+
+    def sample_image(self):
+        """ Read the next frame of the sampling mode, seek to it when the gap is longer than seek_frames """
+        target = (self.cur_frame_id // self.div_fps + 1) * self.div_fps
+        if target - self.cur_frame_id > self.seek_frames:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, target - 1)
+            self.cur_frame_id = target - 1
+        while self.cur_frame_id < target - 1:
+            self.capture.grab()
+            self.cur_frame_id += 1
+        ret, img = self.read_frame()
+        self.cur_frame_id += 1
+        return ret, img, {'sec': self.start_sec + (self.cur_frame_id / self.fps), 'curframe': self.cur_frame_id}
+
     def read_image(self):
-        ret, t = True, 0
+        ret, img, info = self.sample_image() if self.sample_sec else self.next_image()
+        if ret and img is not None:
+            self.frame_change.update(img, info)
+        return ret, img, info
+
+    def next_image(self):
+        """ Read the next frame of div_fps """
+        ret, img, t = True, None, 0
         while t < self.read_times_thres:
             t += 1
-            ret, img = self.capture.read()
             self.cur_frame_id += 1
+            if self.cur_frame_id % self.div_fps and t < self.read_times_thres:
+                # Skip the frame by div_fps without decoding it
+                ret, img = self.capture.grab(), None
+                continue
+            ret, img = self.read_frame()
             if ret and self.cur_frame_id % self.div_fps == 0:
                 break
         return ret, img, {'sec': self.start_sec + (self.cur_frame_id / self.fps), 'curframe': self.cur_frame_id}
 
-    def read(self, frame):
+    def read_frame(self):
+        """ Decode the next frame from capture """
+        return self.capture.read()
+
+    def read(self, frame, timeout=None):
         """ Read new image from stream """
         try:
-            ret, frame, img, info = self.queue.get(timeout=1)
+            ret, frame, img, info = self.queue.get(timeout=self.read_timeout if timeout is None else timeout)
             if not ret:
                 self.stop_signal = True
         except Exception:
@@ -156,21 +292,265 @@ class VideoStream(Stream):
         """ Read new image from stream """
         ret, frame = True, -1
         while not self.stop_signal and ret and self.capture.isOpened() and not self.run_stop(frame):
+            start = time.perf_counter() if METRICS.enabled else None
             ret, img, info = self.read_image()
+            if start is not None and ret:
+                METRICS.observe('stream_decode_seconds', self.metrics_labels, time.perf_counter() - start)
+                METRICS.inc('stream_frames_total', self.metrics_labels)
             if 'curframe' in info:
                 frame = info['curframe'] if ret else self.epochframes
+            # block until the consumer takes an image when the queue is full
             self.queue.put((ret, frame, img, info))
 
-            time.sleep(0.01 / self.fps if self.fps > 0 else 0.0001)
-
         # Stop Stream Process
         self.stop(stop_stream=True)
 
 
+class StoredCapture:
+    """ Stand-in for cv2.VideoCapture of StoredVideoStream when the frames are read from the store """
+    def __init__(self):
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+
+class StoredVideoStream(VideoStream):
+    """ VideoStream which keeps the decoded frames in a FrameStore.
+
+    The first pass decodes the video as VideoStream and appends the images (after div_fps, resized to the size of
+    the store) to the store, which is committed when the video is read to the end. The next passes read zero-copy
+    views of the memory-mapped store without decoding.
+    """
+    def __init__(
+        self, frame_store, source, define, div_fps=1, save_dir='', SYSDTFORMAT='%Y%m%d%H%M%S', queue_maxsize=100
+    ):
+        super().__init__(source, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT, queue_maxsize=queue_maxsize)
+        self.frame_store = frame_store
+        self.stored = None
+        self.store_writer = None
+        self.position = 0
+        self.reached_end = False
+        if not self.capture.isOpened() or self.fps <= 0:
+            return
+        if frame_store.size is not None:
+            self.width, self.height = float(frame_store.size[0]), float(frame_store.size[1])
+        self.stored = frame_store.open(source, self.div_fps)
+        if self.stored is not None:
+            self.capture.release()
+            self.capture = StoredCapture()
+        else:
+            expected_bytes = int(self.maxframes // self.div_fps * self.width * self.height * 3)
+            self.store_writer = frame_store.writer(
+                source, self.div_fps, {'source': str(source), 'fps': self.fps, 'div_fps': self.div_fps},
+                expected_bytes=expected_bytes)
+
+    def read_frame(self):
+        ret, img = self.capture.read()
+        if ret and img is not None:
+            img = self.frame_store.resize(img)
+        return ret, img
+
+    def seek(self, frame):
+        if self.stored is not None:
+            self.position = int(np.searchsorted(self.stored.index['frame'], frame, side='right'))
+            self.cur_frame_id = frame
+            return
+        # only a complete pass is stored
+        if self.store_writer is not None:
+            self.store_writer.discard()
+            self.store_writer = None
+        super().seek(frame)
+
+    def read_stored(self):
+        if self.position >= len(self.stored):
+            return False, None, {'sec': self.start_sec + (self.cur_frame_id / self.fps), 'curframe': self.cur_frame_id}
+        self.cur_frame_id = int(self.stored.index[self.position]['frame'])
+        img = self.stored.frames[self.position]
+        self.position += 1
+        info = {'sec': self.start_sec + (self.cur_frame_id / self.fps), 'curframe': self.cur_frame_id}
+        return True, img, self.frame_change.update(img, info)
+
+    def read_image(self):
+        if self.stored is not None:
+            ret, img, info = self.read_stored()
+        else:
+            ret, img, info = super().read_image()
+            if ret and img is not None and self.store_writer is not None:
+                self.store_writer.write(info['curframe'], self.capture.get(cv2.CAP_PROP_POS_MSEC), img)
+        if not ret:
+            self.reached_end = True
+        return ret, img, info
+
+    def run_stop(self, frame):
+        if super().run_stop(frame):
+            self.reached_end = True
+            return True
+        return False
+
+    def stop(self, stop_stream=True):
+        # only a video which is read to the end is stored
+        if self.store_writer is not None and stop_stream:
+            if self.reached_end:
+                self.store_writer.commit()
+            else:
+                self.store_writer.discard()
+            self.store_writer = None
+        super().stop(stop_stream=stop_stream)
+
+
+class EventStopSignal:
+    """ Share stop_signal between processes through a multiprocessing Event (self.stop_event). """
+    @property
+    def stop_signal(self):
+        return self.stop_event.is_set()
+
+    @stop_signal.setter
+    def stop_signal(self, value):
+        if value:
+            self.stop_event.set()
+
+
+class ProcessCapture:
+    """ Stand-in for cv2.VideoCapture in the consumer process of ProcessVideoStream """
+    def __init__(self, stop_event, opened):
+        self.stop_event = stop_event
+        self.opened = opened
+
+    def isOpened(self):
+        return self.opened and not self.stop_event.is_set()
+
+    def release(self):
+        self.stop_event.set()
+
+
+class WorkerVideoStream(EventStopSignal, VideoStream):
+    """ VideoStream in the worker process, decodes into the slots of the frame ring and queues the slot index """
+    def __init__(self, stop_event, ring, *args, **kwargs):
+        self.stop_event = stop_event
+        self.ring = ring
+        self.slot = None
+        super().__init__(*args, **kwargs)
+
+    def read_frame(self):
+        if self.slot is None:
+            self.slot = self.ring.acquire(timeout=0)
+        if self.slot is None:
+            # every slot is still used by the consumer, fall back to pickle the image
+            with self.ring.fallbacks.get_lock():
+                self.ring.fallbacks.value += 1
+                if self.ring.fallbacks.value == 1:
+                    logger.warning(
+                        'Every frame slot of %s is in use, the images are pickled (stream_ring_fallbacks_total), the '
+                        'consumer keeps too many images' % self.metrics_labels[0][1])
+            return self.capture.read()
+        return self.capture.read(self.ring.array(self.slot))
+
+    def read_image(self):
+        ret, img, info = super().read_image()
+        if ret and self.slot is not None and self.ring.is_slot(self.slot, img):
+            img, self.slot = self.slot, None
+        return ret, img, info
+
+
+class ProcessVideoStream(EventStopSignal, VideoStream):
+    """ VideoStream which decodes the video in a worker process.
+
+    The capture is only probed here for the video information. Frames are decoded into a shared memory FrameRing
+    and only the slot index comes back through a multiprocessing queue, so read(frame) keeps the same contract as
+    VideoStream and returns a zero-copy view of the slot. Use self.process as the stream thread.
+    """
+    MP_CONTEXT = 'spawn'
+    START_WAIT_SEC = 30
+    RING_EXTRA_SLOTS = 4  # slots for the images which are still used by the consumer
+
+    def __init__(self, source, define, div_fps=1, save_dir='', SYSDTFORMAT='%Y%m%d%H%M%S', queue_maxsize=100):
+        from .ring import FrameRing  # multiprocessing.shared_memory needs python 3.8, only import it for this backend
+
+        ctx = mp.get_context(ProcessVideoStream.MP_CONTEXT)
+        self.stop_event = ctx.Event()
+        self.ready_event = ctx.Event()
+        self.start_frame = ctx.Value('q', 0)
+        super().__init__(
+            source, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT, queue=ctx.Queue(maxsize=queue_maxsize))
+
+        # release the probe capture, the worker opens its own one
+        opened = self.capture.isOpened()
+        self.capture.release()
+        self.capture = ProcessCapture(self.stop_event, opened)
+        self.ring = FrameRing(
+            ctx, queue_maxsize + ProcessVideoStream.RING_EXTRA_SLOTS, (int(self.height), int(self.width), 3))
+        self.process = ctx.Process(
+            target=ProcessVideoStream.worker,
+            args=(
+                source, self.video_define, div_fps, save_dir, SYSDTFORMAT, self.start_sec, self.queue, self.ring,
+                self.stop_event, self.ready_event, self.start_frame
+            ),
+            daemon=True
+        )
+
+    @staticmethod
+    def worker(
+        source, define, div_fps, save_dir, SYSDTFORMAT, start_sec, queue, ring, stop_event, ready_event, start_frame
+    ):
+        """ Decode the video in the worker process """
+        stream = WorkerVideoStream(
+            stop_event, ring, source, define, div_fps, save_dir, SYSDTFORMAT=SYSDTFORMAT, queue=queue)
+        stream.start_sec = start_sec
+        if start_frame.value:
+            stream.seek(start_frame.value)
+        ready_event.set()
+        stream.run()
+
+    def seek(self, frame):
+        """ Continue after the frame, the worker seeks when it starts """
+        self.start_frame.value = frame
+        self.cur_frame_id = frame
+
+    @property
+    def read_timeout(self):
+        """ Wait longer until the worker opened its capture """
+        return VideoStream.read_timeout if self.ready_event.is_set() else ProcessVideoStream.START_WAIT_SEC
+
+    def _wait_worker(self, timeout):
+        """ Wait until the worker opened its capture, raise if the worker process exited before """
+        deadline = time.time() + timeout
+        while not self.ready_event.is_set():
+            if self.process.exitcode is not None:
+                raise RuntimeError(
+                    "The worker process of %s exited (code %s) before it opened the video. The 'process' stream "
+                    "backend spawns its workers, so the script must start the streams under "
+                    "if __name__ == '__main__':" % (self.metrics_labels[0][1], self.process.exitcode))
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.ready_event.wait(min(remaining, 0.1))
+
+    def read(self, frame, timeout=None):
+        """ Read new image from the worker process """
+        if not self.ready_event.is_set():
+            self._wait_worker(self.read_timeout if timeout is None else timeout)
+        ret, frame, img, info = super().read(frame, timeout=timeout)
+        if self.ring.linked and self.ready_event.is_set():
+            # both processes mapped the ring, its name can be removed
+            self.ring.unlink()
+        if isinstance(img, int):
+            img = self.ring.view(img)
+        if ret and METRICS.enabled:
+            # the worker process decodes, only the received images are counted here
+            METRICS.inc('stream_frames_total', self.metrics_labels)
+        return ret, frame, img, info
+
+
 class LiveVideoStream(Stream):
+    SKIPPED_IMAGE = object()  # placeholder of the grabbed frame which is skipped by div_fps
+
     def __init__(
         self, stream_info, stream_define, video_sec, div_fps, save_dir, SYSDTFORMAT, YMDFORMAT, queue=None,
-        queue_maxsize=10, warn=True
+        queue_maxsize=10, warn=True, queue_policy='drop_oldest'
     ):
         # info
         stream_define['parent_folder'] = [stream_info['group'], stream_info['channel'], None]
@@ -182,6 +562,10 @@ class LiveVideoStream(Stream):
         self.password = stream_info['password']
         self.group = stream_info['group']
         self.channel = stream_info['channel']
+        # capture_factory(url) returns a cv2.VideoCapture-like capture, e.g. SimulatedCamera
+        self.capture_factory = stream_info.get('capture_factory', cv2.VideoCapture)
+        self.frame_change = FrameChange()
+        self.metrics_labels = (('stream', '%s/%s' % (self.group, self.channel)), )
         # var
         self.video_sec = video_sec
         self.div_fps = div_fps
@@ -192,7 +576,7 @@ class LiveVideoStream(Stream):
         # cfg
         self.capture = None
         self.queue_maxsize = queue_maxsize
-        self.queue = Queue(maxsize=self.queue_maxsize) if queue is None else queue
+        self.queue = ReadyQueue(maxsize=self.queue_maxsize, policy=queue_policy) if queue is None else queue
         self.disc_frame_thres = 5  # 5 times in read error
         self.lost_internet_wait_sec = 6 * 0.1  # 0.1 minutes in seconds
         self.queue_wait_sec = self.queue_maxsize * 16 * 0.5   # max 16 channels and tolerance second
@@ -218,20 +602,30 @@ class LiveVideoStream(Stream):
         self.fps = 0
         self.prev_real_sec = None
         # check queue
-        wt = time.time()
         if self.queue.qsize():
             logger.warning('Waiting to infer %s size of queue ...' % str(self.queue.qsize()))
-            while self.queue.qsize() and (time.time() - wt <= self.queue_wait_sec):
-                time.sleep(0.01)
+            if isinstance(self.queue, ReadyQueue):
+                self.queue.wait_empty(timeout=self.queue_wait_sec)
+            else:
+                wt = time.time()
+                while self.queue.qsize() and (time.time() - wt <= self.queue_wait_sec):
+                    time.sleep(0.01)
         if self.queue.qsize():
             logger.warning('Remain %s queue size.' % str(self.queue.qsize()))
             logger.warning('Timeout while waiting to infer images queue in %s!!' % str(self.start_time))
-        self.queue.queue.clear()
+        if isinstance(self.queue, ReadyQueue):
+            self.queue.clear()
+        else:
+            self.queue.queue.clear()
 
         # error handling
         self.disc_frame_count = 0
         self.drop_frame_count = 0
 
+    @property
+    def read_timeout(self):
+        return self.lost_internet_wait_sec
+
     def reset_attemps(self):
         self.reconnection_attemps = 20
 
@@ -264,9 +658,11 @@ class LiveVideoStream(Stream):
         self.prev_frame = cur_frame
         self.prev_frame_id = cur_frame_id
 
-        # Check to release the queue space
-        if self.queue.full():
-            self.queue.get()
+        # Put new information to queue by the queue policy
+        if METRICS.enabled:
+            METRICS.inc('stream_frames_total', self.metrics_labels)
+        info = self.frame_change.update(img, {'sec': cur_real_sec, 'frame': cur_frame, 'curframe': cur_frame_id})
+        if offer(self.queue, (ret, img, info)):
             if self.warnning:
                 logger.warning('Drop camera queue!')
             if self.drop_frame_count < self.drop_frame_thres:
@@ -276,9 +672,6 @@ class LiveVideoStream(Stream):
         else:
             self.drop_frame_count = 0
 
-        # Put new information to queue
-        self.queue.put((ret, img, {'sec': cur_real_sec, 'frame': cur_frame, 'curframe': cur_frame_id}))
-
     def set_camera(self):
         if self.reconnection_attemps <= 0:
             logger.warning('Reset attempts exausted, scan for possible rtsp url change')
@@ -286,6 +679,8 @@ class LiveVideoStream(Stream):
         else:
             logger.warning('"Camera Disconnected" or "Failed to Load Live Video Image" !!')
             logger.warning('Try to reconnect, attempts remaining: {}'.format(self.reconnection_attemps))
+            if METRICS.enabled:
+                METRICS.inc('stream_reconnects_total', self.metrics_labels)
             self.start()
         return True
 
@@ -293,7 +688,7 @@ class LiveVideoStream(Stream):
         """ Read image from capture """
         while True:
             try:
-                ret, img = self.capture.read()
+                ret, img = self.capture.grab(), None
             except cv2.error as e:
                 ret, img = False, None
                 logger.error("OpenCV exception: %s" % e)
@@ -310,6 +705,8 @@ class LiveVideoStream(Stream):
                 cur_frame_id = int(self.prev_frame_id + max(1, round((cur_real_sec - self.prev_real_sec) * self.fps)))
             else:
                 cur_frame_id = self.div_fps
+            if ret:
+                ret, img = self.retrieve_image(cur_frame_id)
 
             # Camera Error handling
             if fix:
@@ -332,6 +729,23 @@ class LiveVideoStream(Stream):
 
         return ret, img, cur_real_sec, cur_sec, cur_frame, cur_frame_id
 
+    def retrieve_image(self, cur_frame_id):
+        """ Decode the grabbed frame, the frame which will be skipped by div_fps is not decoded """
+        if cur_frame_id % self.div_fps:
+            return True, LiveVideoStream.SKIPPED_IMAGE
+        try:
+            if METRICS.enabled:
+                start = time.perf_counter()
+                ret, img = self.capture.retrieve()
+                METRICS.observe('stream_decode_seconds', self.metrics_labels, time.perf_counter() - start)
+                return ret, img
+            return self.capture.retrieve()
+        except cv2.error as e:
+            logger.error("OpenCV exception: %s" % e)
+        except Exception as e:
+            logger.error("PyThon exception: %s" % e)
+        return False, None
+
     def handle_error(self, ret, img, cur_real_sec, cur_sec, cur_frame):
         """
             （1）影像毀損，代表 camera deocde image 失敗 frame counter 停止 + 1
@@ -388,7 +802,7 @@ class LiveVideoStream(Stream):
         self.reconnection_attemps -= 1
         if self.capture is not None and self.capture.isOpened():
             self.stop()
-        self.capture = cv2.VideoCapture(self.rtsp_url)
+        self.capture = self.capture_factory(self.rtsp_url)
 
         if self.capture.isOpened():
             logger.info('Connect camera successfull !!')
@@ -436,20 +850,21 @@ class LiveVideoStream(Stream):
             return True
         return False
 
-    def get_image(self):
+    def get_image(self, timeout=None):
         try:
-            ret, img, info = self.queue.get(block=True, timeout=self.lost_internet_wait_sec)
+            ret, img, info = self.queue.get(block=True, timeout=self.read_timeout if timeout is None else timeout)
         except Exception:
             self.stop(stop_stream=True)
             ret, img, info = False, None, {}
             logger.warning("Queue is empty!!")
         return ret, img, info
 
-    def read(self, frame):
+    def read(self, frame, timeout=None):
         """ Read new image from stream """
         ret, img, info = False, None, {'sec': -1}
-        while img is None and self.capture.isOpened() and not self.run_stop(frame):
-            ret, img, info = self.get_image()
+        # keep taking the queued images while reconnecting, start() waits for the queue to be empty
+        while img is None and (self.capture.isOpened() or self.queue.qsize()) and not self.run_stop(frame):
+            ret, img, info = self.get_image(timeout=timeout)
             if 'curframe' in info:
                 frame = info['curframe'] if ret else self.epochframes
         return ret, frame, img, info
@@ -469,7 +884,6 @@ class LiveVideoStream(Stream):
 
             else:
                 break
-            time.sleep(0.01 / self.fps if self.fps > 0 else 0.0001)
 
         # Stop Stream Process
         self.stop(stop_stream=True)
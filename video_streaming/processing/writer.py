@@ -1,20 +1,33 @@
 import os
 import cv2
+import glob
 import time
+import uuid
 
 from queue import Queue
 from loguru import logger
+from threading import Thread, Lock
 
-
-VIDFORMAT = {'.mp4': "mp4v"}
+from .queues import ReadyQueue, offer
+from .encoder import VIDFORMAT, create_encoder
+from .metrics import METRICS
 
 
 class VideoWriter:
+    SPARE_PREFIX = '.next_'
+    _cleaned_folders = set()  # folders whose stale spare files were removed by this process
+    _cleaned_lock = Lock()
     def __init__(
         self, save_dir, video_define, start_time, runfps, width, height, init_writer=False, vid_reload=False, title='',
         vid_format='.mp4', queue=None, queue_maxsize=200, visualizer=None, keepdate=False, keepname=False,
-        close_prev_window=True
+        close_prev_window=True, queue_policy='drop_oldest', encoder='opencv', encoder_options=None,
+        metrics_labels=(), copy_frames=False
     ):
+        """
+        Args:
+            copy_frames: Queue copies of the images which do not own their data (e.g. the shared memory views of the
+                process backend), so the queued images do not hold the frame slots of the stream.
+        """
         self.save_dir = save_dir
         self.video_define = video_define
         self.start_time = start_time
@@ -26,17 +39,26 @@ class VideoWriter:
         self.vid_reload = vid_reload
         self.keepdate = keepdate
         self.keepname = keepname
+        self.name_suffix = ''  # appended to the video name, e.g. the segment of a resumed video
+        self.encoder = encoder
+        self.encoder_options = encoder_options
+        self.metrics_labels = metrics_labels
+        self.copy_frames = copy_frames
         # init
         self.close_prev_window = close_prev_window
         self.WINDOW_NAME = None
         self.CUR_WINDOW_NAME = self.WINDOW_NAME
         self.writer = None
+        self.writer_paths = None  # (path of the writer, final path of the video)
+        self.spare = None  # writer of the next segment which is opened in background (vid_reload)
+        self.spare_lock = Lock()
+        self.background = None
         self.already_init_writer = init_writer
         self.stop_flag = True
         self.internal_show = False
         self.visualizer = visualizer
         self.queue_maxsize = queue_maxsize
-        self.queue = Queue(maxsize=self.queue_maxsize) if queue is None else queue
+        self.queue = ReadyQueue(maxsize=self.queue_maxsize, policy=queue_policy) if queue is None else queue
         self._update_writer(start_time, is_need_new_writer=init_writer)
 
     def _init_writer_path(self, start_time, current_date_time=""):
@@ -49,7 +71,7 @@ class VideoWriter:
         self.save_folder = os.path.join(
             self.save_dir, *[f for f in self.video_define['parent_folder'] if f is not None])
         self.save_folder = self.save_folder if len(self.save_folder) else '.' + os.sep
-        self.save_path = os.path.join(self.save_folder, self.start_time + self.vid_format)
+        self.save_path = os.path.join(self.save_folder, self.start_time + self.name_suffix + self.vid_format)
         self.WINDOW_NAME = 'Process Video Streaming in %s' % self.save_path.replace(os.sep, '/')
         if self.close_prev_window and self.CUR_WINDOW_NAME is not None and self.CUR_WINDOW_NAME != self.WINDOW_NAME:
             cv2.destroyWindow(self.CUR_WINDOW_NAME)
@@ -60,10 +82,20 @@ class VideoWriter:
         if is_need_new_writer:
             self.run_stop()
             os.makedirs(self.save_folder, exist_ok=True)
-            self.writer = cv2.VideoWriter(
-                self.save_path, cv2.VideoWriter_fourcc(*VIDFORMAT[self.vid_format]),
-                self.runfps, (int(self.width), int(self.height))
-            )
+            VideoWriter._remove_stale_spares(self.save_folder)
+            spare = self._take_spare()
+            if spare is not None:
+                self.writer, self.writer_paths = spare[0], (spare[1], self.save_path)
+            else:
+                self.writer = create_encoder(
+                    self.encoder, self.save_path, self.runfps, self.width, self.height, vid_format=self.vid_format,
+                    options=self.encoder_options
+                )
+                self.writer_paths = (self.save_path, self.save_path)
+            if self.vid_reload:
+                # the background job gets a snapshot, the writer thread changes them for the next segments
+                folder, size = self.save_folder, (self.runfps, self.width, self.height)
+                self._run_background(lambda: self._prepare_spare(folder, size))
             self.already_init_writer = True
         self.stop_flag = False
         # self.queue.queue.clear()
@@ -94,21 +126,112 @@ class VideoWriter:
         pt = (int(self.width - 100), 30)
         cv2.putText(img, label, pt, 0, 0.5, color, thickness=1, lineType=cv2.LINE_AA)
 
+    def _run_background(self, job):
+        """ Run the job in the background thread of the writer """
+        if self.background is None:
+            self.background = Queue()
+            Thread(target=self._process_background, args=(self.background, ), daemon=True).start()
+        self.background.put(job)
+
+    def _process_background(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as e:
+                logger.error('Background job of the video writer failed: %s' % str(e))
+            finally:
+                jobs.task_done()
+
+    @staticmethod
+    def _remove_stale_spares(folder):
+        """ Remove the spare files which a killed process left in the folder, once per folder """
+        with VideoWriter._cleaned_lock:
+            if folder in VideoWriter._cleaned_folders:
+                return
+            VideoWriter._cleaned_folders.add(folder)
+        for path in glob.glob(os.path.join(glob.escape(folder), VideoWriter.SPARE_PREFIX + '*')):
+            try:
+                os.remove(path)
+                logger.info('Remove the stale spare video %s' % path)
+            except OSError:
+                pass
+
+    def _prepare_spare(self, folder, size):
+        """ Open the writer of the next segment with a temporary name, it is renamed when it is finalized """
+        with self.spare_lock:
+            if self.spare is not None:
+                return
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, '%s%s%s' % (VideoWriter.SPARE_PREFIX, uuid.uuid4().hex, self.vid_format))
+        writer = create_encoder(
+            self.encoder, path, size[0], size[1], size[2], vid_format=self.vid_format, options=self.encoder_options)
+        with self.spare_lock:
+            self.spare = (writer, path, size)
+
+    def _take_spare(self):
+        with self.spare_lock:
+            spare, self.spare = self.spare, None
+        if spare is not None and spare[2] != (self.runfps, self.width, self.height):
+            self._run_background(lambda: VideoWriter._discard(*spare[:2]))
+            return None
+        return spare
+
+    @staticmethod
+    def _discard(writer, path):
+        writer.release()
+        if os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _finalize(writer, writer_paths):
+        writer.release()
+        if writer_paths[0] != writer_paths[1]:
+            os.makedirs(os.path.dirname(writer_paths[1]) or '.', exist_ok=True)
+            os.replace(*writer_paths)
+        logger.info(f"Saved the video in {writer_paths[1]}")
+
+    def rollover(self):
+        """ End the current segment, finalize it in background when the writer will be reloaded """
+        if not self.vid_reload:
+            return self.run_stop()
+        if self.writer is not None:
+            writer, writer_paths = self.writer, self.writer_paths
+            self.writer = None
+            self._run_background(lambda: VideoWriter._finalize(writer, writer_paths))
+            return True
+        return False
+
     def run_stop(self):
         if self.writer is not None:
-            self.writer.release()
+            VideoWriter._finalize(self.writer, self.writer_paths)
             self.writer = None
-            logger.info(f"Saved the video in {self.save_path}")
             return True
         return False
 
+    def close_background(self):
+        """ Wait for the background jobs and release the spare writer """
+        if self.background is None:
+            return
+        self.background.join()
+        spare = self._take_spare()
+        if spare is not None:
+            VideoWriter._discard(*spare[:2])
+        self.background.put(None)
+        self.background = None
+
     def put_frame(self, result_frame, current_date_time, current_time, current_sec, vis='a'):
-        drop = False
-        if self.queue.full():
-            drop = True
-            self.queue.get()
-        self.queue.put((result_frame, current_date_time, current_time, current_sec, vis))
-        return drop
+        """ Put the frame by the queue policy (None is the signal to stop the writer), return True if dropped """
+        if self.copy_frames and result_frame is not None:
+            copies = {}
+            result_frame = {
+                k: img if img is None or img.flags.owndata else copies.setdefault(id(img), img.copy())
+                for k, img in result_frame.items()
+            }
+        return offer(
+            self.queue, (result_frame, current_date_time, current_time, current_sec, vis), control=result_frame is None)
 
     def write_image(self, im0, current_date_time, current_time):
         if self.writer is None:
@@ -144,15 +267,20 @@ class VideoWriter:
             if imgs is None:
                 # stop the current writer
                 if current_time:
-                    self.run_stop()
+                    self.rollover()
                 else:
                     break
             else:
                 # write
                 if self._check_write(write, vis):
+                    start = time.perf_counter() if METRICS.enabled else None
                     res = self.write_image(imgs['write'], current_date_time, current_time)
                     if res:
                         break
+                    if start is not None:
+                        METRICS.observe('writer_encode_seconds', self.metrics_labels, time.perf_counter() - start)
+                        METRICS.observe('writer_frame_age_seconds', self.metrics_labels, time.time() - current_sec)
+                        METRICS.inc('writer_frames_total', self.metrics_labels)
 
                 # show
                 if self._check_show(show, vis):
@@ -166,4 +294,5 @@ class VideoWriter:
         if self.internal_show and self._check_show(show, vis) and self.visualizer is None:
             cv2.destroyWindow(self.WINDOW_NAME)
         self.run_stop()
+        self.close_background()
         logger.info('Stop video writer thread.')
@@ -2,6 +2,8 @@ import cv2
 import sys
 import time
 import copy
+import asyncio
+import numpy as np
 
 from tqdm import tqdm
 from pathlib import Path
@@ -9,8 +11,11 @@ from loguru import logger
 
 if Path(__file__).parent not in sys.path:
     sys.path.append(str(Path(__file__).parent))
-from processing.datasets import LoadBatchVideos
+from processing.datasets import LoadBatchVideos, BatchBuffer
 from processing.manager import VideoManagers
+from processing.multiplexer import StreamMultiplexer, AsyncStreamMultiplexer
+from processing.metrics import METRICS
+from processing.preprocess import BatchPreprocessor
 from processing.strategy import OnlyShowStrategy
 
 
@@ -21,8 +26,13 @@ class StreamingRunner:
         self, video_sources, video_defines=None, vid_batch=1, div_fps=1, preproc=None, imgsz=(640, 640), save_dir='./',
         vis_mode='write', queue_maxsize=10, vid_queue_maxsize=200, video_sec=600, visualizer=None, end_title='',
         SYSDTFORMAT='%Y%m%d%H%M%S', YMDFORMAT='%Y%m%d000000', warnning=True, start=False, close_prev_window=True,
-        processing_strategy=OnlyShowStrategy
+        processing_strategy=OnlyShowStrategy, stream_backend='thread', max_batch=1, max_wait_ms=10,
+        queue_policy='drop_oldest', vid_queue_policy='drop_oldest', encoder='opencv', encoder_options=None,
+        metrics_port=None, skip_unchanged=None, motion_gate=None, result_cache=None, frame_store=None,
+        checkpoint=None, max_open=0
     ):
+        if metrics_port is not None:
+            METRICS.serve(port=metrics_port)
         self.video_sources, self.video_defines = StreamingRunner.update_video_info(video_sources, video_defines)
         if isinstance(self.video_sources, dict):
             # Create VideoManager
@@ -31,7 +41,8 @@ class StreamingRunner:
                 self.video_sources, self.video_defines, div_fps, save_dir, vis_mode, video_sec=video_sec,
                 visualizer=visualizer, end_title=end_title, SYSDTFORMAT=SYSDTFORMAT, YMDFORMAT=YMDFORMAT,
                 warn=warnning, queue_maxsize=queue_maxsize, vid_queue_maxsize=vid_queue_maxsize,
-                close_prev_window=close_prev_window
+                close_prev_window=close_prev_window, stream_backend=stream_backend, queue_policy=queue_policy,
+                vid_queue_policy=vid_queue_policy, encoder=encoder, encoder_options=encoder_options
             )
         else:
             # Create Dataset
@@ -39,11 +50,28 @@ class StreamingRunner:
                 self.video_sources, self.video_defines, vid_batch, div_fps, save_dir, preproc, img_size=imgsz,
                 video_sec=video_sec, vis_mode=vis_mode, SYSDTFORMAT=SYSDTFORMAT, YMDFORMAT=YMDFORMAT,
                 visualizer=visualizer, queue_maxsize=queue_maxsize, vid_queue_maxsize=vid_queue_maxsize,
-                close_prev_window=close_prev_window
+                close_prev_window=close_prev_window, stream_backend=stream_backend, vid_queue_policy=vid_queue_policy,
+                encoder=encoder, encoder_options=encoder_options, frame_store=frame_store, checkpoint=checkpoint,
+                max_open=max_open
             )
             self.video_managers = None
         self.visualizer = visualizer
         self.processing_strategy = processing_strategy
+        # dynamic batch across the video managers
+        self.preproc = preproc
+        self.imgsz = imgsz
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.batch_buffer = BatchBuffer(self.max_batch)
+        # reuse the last output of the stream for unchanged images (info['repeat'] or info['diff'] <= skip_unchanged)
+        self.skip_unchanged = skip_unchanged
+        self.last_outputs = {}
+        # only the images forwarded by the motion gate are processed by the strategy, the others reuse the last
+        # write decision (process_image) of their stream
+        self.motion_gate = motion_gate
+        self.last_writes = {}
+        # the cached outputs of the video files skip pre_process_images
+        self.result_cache = result_cache
 
         # Initialize status
         if start:
@@ -109,39 +137,232 @@ class StreamingRunner:
         if img_info["is_epochfinal"]:
             manager.vid_writer.put_frame(None, *vid_info)
 
-    def process_batch_images(self):
-        # Iter video streaming
-        pbar = tqdm(enumerate(self.dataset), total=None if any([
-            True if m.mode == 'webcam' else False for m in self.dataset.video_managers.values()
-        ]) else len(self.dataset))
-        logger.info(self.dataset.title + self.dataset.end_title)
-        for _, (imgs_info, imgs) in pbar:
-            if imgs is None:
+    @staticmethod
+    def _subset(imgs, indices):
+        return imgs[indices] if isinstance(imgs, np.ndarray) else [imgs[i] for i in indices]
+
+    def process_or_reuse(self, manager, img_info, image_info):
+        """ process_image of the strategy, a gated image is written only if the last processed image of its stream
+            was written """
+        if img_info.get("gated", False):
+            return self.last_writes.get(img_info["id"], False)
+        w = self.last_writes[img_info["id"]] = self.processing_strategy.process_image(manager, image_info)
+        return w
+
+    def gate_images(self, imgs_info):
+        """ Indices of the images which the motion gate forwards, the others are marked by img_info["gated"] """
+        if self.motion_gate is None:
+            return list(range(len(imgs_info)))
+        forwarded = []
+        for i, img_info in enumerate(imgs_info):
+            forward, img_info["motion"] = self.motion_gate.check(
+                img_info["id"], img_info["raw_img"], img_info["info"].get('sec'))
+            img_info["gated"] = not forward
+            if forward:
+                forwarded.append(i)
+        return forwarded
+
+    def pre_process_forwarded(self, imgs_info, imgs, sys_info):
+        """ pre_process_images of the images forwarded by the motion gate, the outputs of the gated images are None """
+        forwarded = self.gate_images(imgs_info)
+        if len(forwarded) == len(imgs_info):
+            return self.pre_process_changed(imgs_info, imgs, sys_info)
+        outputs = [None] * len(imgs_info)
+        if len(forwarded):
+            new_outputs = self.pre_process_changed(
+                [imgs_info[i] for i in forwarded], StreamingRunner._subset(imgs, forwarded), sys_info)
+            for i, output in zip(forwarded, new_outputs):
+                outputs[i] = output
+        return outputs
+
+    def is_unchanged(self, img_info):
+        """ Whether the image is unchanged (see skip_unchanged) and its stream has an output to reuse """
+        if self.skip_unchanged is None or img_info["id"] not in self.last_outputs:
+            return False
+        info = img_info.get("info", {})
+        diff = info.get('diff')
+        return info.get('repeat', False) or (diff is not None and diff <= self.skip_unchanged)
+
+    def cache_path(self, k):
+        """ Video file of the stream k for the result cache, None if the stream is not a video file of the dataset """
+        if self.result_cache is None or self.dataset is None:
+            return None
+        manager, path = self.dataset.video_managers.get(k), self.dataset.files.get(k)
+        if manager is None or manager.mode != 'video' or not isinstance(path, str):
+            return None
+        return path
+
+    def cached_output(self, img_info):
+        """ (hit, output) of the image in the result cache, only for the video files of the dataset """
+        path = self.cache_path(img_info["id"])
+        if path is None or 'curframe' not in img_info.get("info", {}):
+            return False, None
+        hit, output = self.result_cache.get(path, img_info["info"]['curframe'])
+        img_info["cached"] = hit
+        return hit, output
+
+    def pre_process_changed(self, imgs_info, imgs, sys_info):
+        """ pre_process_images of the changed images only, the result cache hits reuse the cached output (marked by
+            img_info["cached"]) and the unchanged images reuse the last output of their stream
+            (img_info["unchanged"]) """
+        if self.skip_unchanged is None and self.result_cache is None:
+            return self.processing_strategy.pre_process_images(imgs_info, imgs, sys_info)
+        reused, changed = {}, []
+        for i, img_info in enumerate(imgs_info):
+            hit, output = self.cached_output(img_info)
+            if hit:
+                reused[i] = output
                 continue
-            sys_info = {'start': time.time(), 'infer': 0.0}
-
-            # Pre-processing batch images
+            if self.skip_unchanged is not None:
+                img_info["unchanged"] = self.is_unchanged(img_info)
+                if img_info["unchanged"]:
+                    reused[i] = self.last_outputs[img_info["id"]]
+                    continue
+            changed.append(i)
+        if not len(reused):
             outputs = self.processing_strategy.pre_process_images(imgs_info, imgs, sys_info)
+            new_outputs = {i: outputs[i] for i in range(min(len(outputs), len(imgs_info)))}
+        else:
+            new_outputs = {}
+            if len(changed):
+                new_outputs = dict(zip(changed, self.processing_strategy.pre_process_images(
+                    [imgs_info[i] for i in changed], StreamingRunner._subset(imgs, changed), sys_info)))
+            outputs = [reused[i] if i in reused else new_outputs.get(i) for i in range(len(imgs_info))]
+            if METRICS.enabled and self.skip_unchanged is not None:
+                METRICS.inc('runner_skipped_frames_total', value=sum(
+                    1 for img_info in imgs_info if img_info.get("unchanged", False)))
+        for i, img_info in enumerate(imgs_info):
+            self.last_outputs[img_info["id"]] = outputs[i] if i <= len(outputs) - 1 else None
+            path = self.cache_path(img_info["id"]) if i in changed else None
+            if path is not None and 'curframe' in img_info["info"]:
+                self.result_cache.put(path, img_info["info"]['curframe'], new_outputs.get(i))
+        return outputs
+
+    def release_cached(self):
+        """ Release the cached outputs of the ended videos from the memory """
+        for k in self.dataset.ended:
+            path = self.dataset.files.get(k)
+            if isinstance(path, str):
+                self.result_cache.release(path)
+
+    def process_batch(self, imgs_info, imgs):
+        """ Process a batch of images from dataset """
+        sys_info = {'start': time.time(), 'infer': 0.0}
+
+        # Pre-processing batch images
+        outputs = self.pre_process_forwarded(imgs_info, imgs, sys_info)
+
+        # Processing batch images
+        for i, img_info in enumerate(imgs_info):
+
+            # processing image and show output information in image
+            manager = self.dataset.video_managers[img_info["id"]]
+            output = outputs[i] if i <= len(outputs) - 1 else None
+            w = self.process_or_reuse(manager, img_info, {'img_info': img_info, 'ori_img': imgs[i], 'out': output})
+            if self.processing_strategy.check_stop(manager, img_info):
+                manager.stop()
+                continue
 
-            # Processing batch images
-            for i, img_info in enumerate(imgs_info):
+            # show
+            if w and manager.vid_thread is not None:
+                self.write_video(manager, img_info)
+                # cur_date_time, cur_second, cur_time, _ = manager.stream.get_cur_info(img_info['cur_sec'])
+                # manager.vid_writer.put_frame(img_info["raw_img"], cur_date_time, cur_time, cur_second, vis='a')
+        if METRICS.enabled:
+            METRICS.observe('runner_process_seconds', value=time.time() - sys_info['start'])
+            METRICS.inc('runner_frames_total', value=len(imgs_info))
+        return sys_info
+
+    def process_frame(self, k, ret, frame, img, info):
+        """ Process an image from the video managers """
+        if not ret or img is None:
+            return
+        sys_info = {'start': time.time(), 'infer': 0.0}
+        img_info = {
+            "id": k, "raw_img": img, "frame": frame, "info": info, "is_newepoch": False, "is_epochfinal": False
+        }
+
+        # Pre-processing batch images
+        if self.motion_gate is not None and not len(self.gate_images([img_info])):
+            output = None
+        elif self.is_unchanged(img_info):
+            img_info["unchanged"], output = True, self.last_outputs[k]
+            if METRICS.enabled:
+                METRICS.inc('runner_skipped_frames_total')
+        else:
+            output = self.processing_strategy.pre_process_images(img_info, img, sys_info)
+            if self.skip_unchanged is not None:
+                img_info["unchanged"], self.last_outputs[k] = False, output
+        self._process_frame_output(ret, img_info, output)
+        if METRICS.enabled:
+            METRICS.observe('runner_process_seconds', value=time.time() - sys_info['start'])
+            METRICS.inc('runner_frames_total')
+
+    def process_frames(self, reads):
+        """ Process the images from the video managers as one batch (max_batch > 1).
+            pre_process_images gets a list of image information and the images, which are stacked into an array when
+            preproc is given (otherwise a list of the raw images, the cameras can have different sizes). """
+        imgs_info, imgs = [], []
+        self.batch_buffer.reset()
+        for k, ret, frame, img, info in reads:
+            if not ret or img is None:
+                continue
+            imgs_info.append({
+                "id": k, "raw_img": img, "frame": frame, "info": info, "is_newepoch": False, "is_epochfinal": False
+            })
+            if self.preproc is not None and not isinstance(self.preproc, BatchPreprocessor):
+                self.batch_buffer.put(self.preproc(img, None, self.imgsz)[0])
+            else:
+                imgs.append(img)
+        if not len(imgs_info):
+            return
+        sys_info = {'start': time.time(), 'infer': 0.0}
+        if isinstance(self.preproc, BatchPreprocessor):
+            imgs = self.preproc.process(imgs, self.imgsz)
+        elif self.preproc is not None:
+            imgs = self.batch_buffer.view()
+
+        # Pre-processing batch images
+        outputs = self.pre_process_forwarded(imgs_info, imgs, sys_info)
+        for i, img_info in enumerate(imgs_info):
+            self._process_frame_output(True, img_info, outputs[i] if i <= len(outputs) - 1 else None)
+        if METRICS.enabled:
+            METRICS.observe('runner_process_seconds', value=time.time() - sys_info['start'])
+            METRICS.inc('runner_frames_total', value=len(imgs_info))
+
+    def _process_frame_output(self, ret, img_info, output):
+        manager, info = self.video_managers[img_info["id"]], img_info["info"]
+
+        # processing image and show output information in image
+        w = self.process_or_reuse(manager, img_info, {'ret': ret, 'img_info': img_info, 'out': output})
+        if self.processing_strategy.check_stop(manager, info):
+            manager.stop()
+            return
 
-                # processing image and show output information in image
-                manager = self.dataset.video_managers[img_info["id"]]
-                output = outputs[i] if i <= len(outputs) - 1 else None
-                w = self.processing_strategy.process_image(
-                    manager, {'img_info': img_info, 'ori_img': imgs[i], 'out': output})
-                if self.processing_strategy.check_stop(manager, img_info):
-                    manager.stop()
-                    continue
+        # show
+        if w and manager.vid_thread is not None:
+            cur_date_time, cur_second, cur_time, _ = manager.stream.get_cur_info(info['sec'])
+            img_info["dt"] = cur_date_time
+            img_info["cur_time"] = cur_time
+            img_info["cur_sec"] = cur_second
+            self.write_video(manager, img_info)
+            # manager.vid_writer.put_frame(img_info["raw_img"], cur_date_time, cur_time, cur_second, vis='a')
 
-                # show
-                if w and manager.vid_thread is not None:
-                    self.write_video(manager, img_info)
-                    # cur_date_time, cur_second, cur_time, _ = manager.stream.get_cur_info(img_info['cur_sec'])
-                    # manager.vid_writer.put_frame(img_info["raw_img"], cur_date_time, cur_time, cur_second, vis='a')
+    def is_streaming(self):
+        return not all([m.stream.stop_stream for m in self.video_managers.values()])
 
-            pbar.set_description(('%20.4f' * 2) % (sys_info['infer'], time.time() - sys_info['start']))
+    def process_batch_images(self):
+        # Iter video streaming
+        pbar = tqdm(enumerate(self.dataset), total=None if self.dataset.max_open or any([
+            True if m.mode == 'webcam' else False for m in self.dataset.video_managers.values()
+        ]) else len(self.dataset))
+        logger.info(self.dataset.title + self.dataset.end_title)
+        for _, (imgs_info, imgs) in pbar:
+            if imgs is not None:
+                sys_info = self.process_batch(imgs_info, imgs)
+                pbar.set_description(('%20.4f' * 2) % (sys_info['infer'], time.time() - sys_info['start']))
+            if self.result_cache is not None:
+                self.release_cached()
 
         # Stop the video manager
         time.sleep(1)
@@ -153,40 +374,16 @@ class StreamingRunner:
 
     def process_image(self):
         # Show video streaming
-        frames = {}
-        while not all([m.stream.stop_stream for m in self.video_managers.values()]):
-            for k, manager in self.video_managers.items():
-                # init frame
-                if k not in frames:
-                    frames[k] = 1
-
-                # read new frame
-                ret, frames[k], img, info = manager.stream.read(frames[k])
-                if not ret or img is None:
-                    continue
-                sys_info = {'start': time.time(), 'infer': 0.0}
-                img_info = {
-                    "raw_img": img, "frame": frames[k], "info": info, "is_newepoch": False, "is_epochfinal": False
-                }
-
-                # Pre-processing batch images
-                output = self.processing_strategy.pre_process_images(img_info, img, sys_info)
-
-                # processing image and show output information in image
-                w = self.processing_strategy.process_image(
-                    manager, {'ret': ret, 'img_info': img_info, 'out': output})
-                if self.processing_strategy.check_stop(manager, info):
-                    manager.stop()
-                    continue
-
-                # show
-                if w and manager.vid_thread is not None:
-                    cur_date_time, cur_second, cur_time, _ = manager.stream.get_cur_info(info['sec'])
-                    img_info["dt"] = cur_date_time
-                    img_info["cur_time"] = cur_time
-                    img_info["cur_sec"] = cur_second
-                    self.write_video(manager, img_info)
-                    # manager.vid_writer.put_frame(img_info["raw_img"], cur_date_time, cur_time, cur_second, vis='a')
+        frames = {k: 1 for k in self.video_managers.keys()}
+        multiplexer = StreamMultiplexer({k: m.stream for k, m in self.video_managers.items()})
+        while self.is_streaming():
+            # read new frames from the streams which are ready
+            if self.max_batch > 1:
+                self.process_frames(multiplexer.collect(frames, self.max_batch, self.max_wait_ms / 1000))
+                continue
+            for k, ret, frame, img, info in multiplexer.select(frames):
+                self.process_frame(k, ret, frame, img, info)
+        multiplexer.close()
 
         # Stop the video manager
         time.sleep(1)
@@ -206,6 +403,10 @@ class StreamingRunner:
             self.process_batch_images()
         elif self.video_managers is not None:
             self.process_image()
+        if self.motion_gate is not None:
+            self.motion_gate.report()
+        if self.result_cache is not None:
+            self.result_cache.flush()
 
         # stop visualize
         if self.visualizer is not None and stop_visualizer and not self.visualizer.stop_flag:
@@ -214,6 +415,71 @@ class StreamingRunner:
         self.stop_flag = True
 
 
+class AsyncStreamingRunner(StreamingRunner):
+    """ StreamingRunner for asyncio services: await runner.run() in the event loop.
+
+    The streams still capture in their own threads, but the runner awaits new images instead of blocking reads, so
+    no thread is needed to bridge each camera into the event loop. Strategies are called as in StreamingRunner.
+    """
+    @staticmethod
+    async def stop_managers(managers):
+        await asyncio.sleep(1)
+        loop = asyncio.get_running_loop()
+        for _, manager in managers.items():
+            await loop.run_in_executor(None, StreamingRunner.stop_manager, manager)
+
+    async def process_batch_images(self):
+        logger.info(self.dataset.title + self.dataset.end_title)
+        try:
+            async for imgs_info, imgs in self.dataset:
+                if imgs is not None:
+                    self.process_batch(imgs_info, imgs)
+                if self.result_cache is not None:
+                    self.release_cached()
+        finally:
+            await self.dataset.aclose()
+
+        # Stop the video manager
+        await AsyncStreamingRunner.stop_managers(self.dataset.video_managers)
+
+    async def process_image(self):
+        frames = {k: 1 for k in self.video_managers.keys()}
+        multiplexer = AsyncStreamMultiplexer({k: m.stream for k, m in self.video_managers.items()})
+        try:
+            while self.is_streaming():
+                if self.max_batch > 1:
+                    self.process_frames(await multiplexer.collect(frames, self.max_batch, self.max_wait_ms / 1000))
+                    continue
+                for k, ret, frame, img, info in await multiplexer.select(frames):
+                    self.process_frame(k, ret, frame, img, info)
+        finally:
+            multiplexer.close()
+
+        # Stop the video manager
+        await AsyncStreamingRunner.stop_managers(self.video_managers)
+
+    async def run(self, stop_visualizer=True):
+        # Start process
+        if self.is_need_start:
+            self._start()
+
+        # Process images
+        if self.dataset is not None:
+            await self.process_batch_images()
+        elif self.video_managers is not None:
+            await self.process_image()
+        if self.motion_gate is not None:
+            self.motion_gate.report()
+        if self.result_cache is not None:
+            self.result_cache.flush()
+
+        # stop visualize
+        if self.visualizer is not None and stop_visualizer and not self.visualizer.stop_flag:
+            await asyncio.get_running_loop().run_in_executor(None, self.visualizer.run_stop)
+
+        self.stop_flag = True
+
+
 def Example():
     # init
     StreamingRunner.DEFINE_TEMPLATE = {"parent_folder": [None, None, None], "start_time": "current"}
@@ -246,7 +512,21 @@ def Example():
         warnning=True,  # Show warnings in the terminal. Set to False to skip showing information.
         start=False,  # Automatically start capturing images from video streaming after successful initialization.
         close_prev_window=True,  # Close previous window when new window be opened.
-        processing_strategy=OnlyShowStrategy  # Create strategy instance by extending the ImageProcessingStrategy class.
+        processing_strategy=OnlyShowStrategy,  # Create strategy instance by extending ImageProcessingStrategy class.
+        stream_backend='thread',  # 'thread' or 'process' (worker processes, run under if __name__ == '__main__').
+        max_batch=1,  # Batch the ready images across cameras (dictionary sources) up to max_batch images.
+        max_wait_ms=10,  # Maximum wait after the first image of a batch when max_batch > 1.
+        queue_policy='drop_oldest',  # Full live queues: 'block', 'drop_oldest', 'drop_newest', 'latest', 'every_nth'.
+        vid_queue_policy='drop_oldest',  # Video writer queues when full, same choices as queue_policy.
+        encoder='opencv',  # 'opencv' or 'ffmpeg' (falls back to opencv if ffmpeg is not installed).
+        encoder_options=None,  # ffmpeg options: {"codec": "libx264", "preset": "veryfast", "crf": 23, "threads": 0}
+        metrics_port=None,  # Serve the metrics in Prometheus text format at http://127.0.0.1:metrics_port/metrics.
+        skip_unchanged=None,  # Reuse the last output when info['repeat'] or info['diff'] <= skip_unchanged (0 ~ 255).
+        motion_gate=None,  # MotionGate instance, only the images with motion (or keep-alive) go to the strategy.
+        result_cache=None,  # ResultCache instance, reuse the outputs of the video files from the previous runs.
+        frame_store=None,  # FrameStore instance, read the decoded frames of the video files from the previous runs.
+        checkpoint=None,  # Checkpoint instance, skip the finished video files and resume the partial ones.
+        max_open=0  # Keep at most max_open video files open, the next file is opened when one ends (0: all files).
     )
 
     # main
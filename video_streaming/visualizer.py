@@ -1,18 +1,163 @@
 import cv2
+import sys
+import math
 import time
+import numpy as np
 
+from pathlib import Path
 from loguru import logger
-from queue import Queue
-from threading import Thread
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+
+if Path(__file__).parent not in sys.path:
+    sys.path.append(str(Path(__file__).parent))
+from processing.queues import ReadyQueue, offer
+from processing.metrics import METRICS
+from processing.encoder import create_encoder
+
+
+class MosaicCompositor:
+    """ Tile the latest image of every stream into one preallocated canvas.
+
+    update() only keeps the latest image of the stream, render() resizes the images which changed since the last
+    render into their tiles (aspect ratio kept), so the images between two renders are never resized. It does not
+    need a display, the canvas can be written to a file or a video.
+
+    Args:
+        size: (height, width) of the canvas.
+        labels: Draw the name of the stream in its tile.
+    """
+    def __init__(self, size=(1080, 1920), labels=True, background=0):
+        self.size = size
+        self.labels = labels
+        self.background = background
+        self.canvas = np.full((size[0], size[1], 3), background, dtype=np.uint8)
+        self.lock = Lock()
+        self.names = []  # tile order
+        self.images = {}  # name: latest image
+        self.dirty = set()
+        self.grid = (0, 0)
+
+    def _layout(self):
+        count = len(self.names)
+        cols = max(1, math.ceil(math.sqrt(count)))
+        rows = max(1, math.ceil(count / cols))
+        if (rows, cols) != self.grid:
+            self.grid = (rows, cols)
+            self.canvas[...] = self.background
+            self.dirty = set(self.names)
+
+    def tile(self, name):
+        """ (top, left, height, width) of the tile of the stream """
+        rows, cols = self.grid
+        i = self.names.index(name)
+        h, w = self.size[0] // rows, self.size[1] // cols
+        return (i // cols) * h, (i % cols) * w, h, w
+
+    def update(self, name, img):
+        """ Set the latest image of the stream, a new stream joins the mosaic """
+        with self.lock:
+            if name not in self.images:
+                self.names.append(name)
+                self._layout()
+            self.images[name] = img
+            self.dirty.add(name)
+
+    def remove(self, name):
+        """ The stream leaves the mosaic, the following tiles move forward """
+        with self.lock:
+            if name not in self.images:
+                return
+            i = self.names.index(name)
+            self.names.remove(name)
+            self.images.pop(name)
+            self.dirty.discard(name)
+            self._layout()
+            # clear the tiles from the removed one
+            self.dirty.update(self.names[i:])
+            rows, cols = self.grid
+            h, w = self.size[0] // rows, self.size[1] // cols
+            for j in range(i, len(self.names) + 1):
+                top, left = (j // cols) * h, (j % cols) * w
+                self.canvas[top:top + h, left:left + w] = self.background
+
+    def render(self):
+        """ Draw the changed tiles and return the canvas (overwritten by the next render) """
+        with self.lock:
+            for name in self.dirty:
+                img = self.images[name]
+                if img is None:
+                    continue
+                top, left, h, w = self.tile(name)
+                r = min(h / img.shape[0], w / img.shape[1])
+                nh, nw = max(1, int(img.shape[0] * r)), max(1, int(img.shape[1] * r))
+                y, x = top + (h - nh) // 2, left + (w - nw) // 2
+                self.canvas[top:top + h, left:left + w] = self.background
+                if img.ndim == 2 or img.shape[2] == 1:
+                    img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+                elif img.shape[2] == 4:
+                    img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+                # resize into the canvas (dst is only written in place if it has the same channels)
+                cv2.resize(img, (nw, nh), dst=self.canvas[y:y + nh, x:x + nw], interpolation=cv2.INTER_AREA)
+                if self.labels:
+                    cv2.putText(
+                        self.canvas, str(name)[-40:], (left + 5, top + 20), 0, 0.5, (0, 255, 0), thickness=1,
+                        lineType=cv2.LINE_AA
+                    )
+            self.dirty = set()
+            return self.canvas
+
+
+class WindowReady:
+    """ Listener of a window queue, marks the window as ready and wakes the display thread """
+    def __init__(self, visualizer, window_name):
+        self.visualizer = visualizer
+        self.window_name = window_name
+
+    def set(self):
+        self.visualizer.ready_windows.add(self.window_name)
+        self.visualizer.ready.set()
 
 
 class Visualizer:
-    def __init__(self, queue=None, maxsize=30, start=True):
+    """ Show the images of the video writers in their own windows, or in one mosaic window (mosaic=True).
+
+    The display thread sleeps until a window queue gets an image, and only shows the latest image of each window (the
+    older images are skipped). cv2.waitKey is called once per render pass.
+
+    Args:
+        max_fps: Maximum FPS of every window (0 is unlimited), see set_max_fps.
+        mosaic: Tile every window into one window, which is refreshed at most mosaic_fps times per second.
+        mosaic_size: (height, width) of the mosaic.
+        mosaic_output: Also write the mosaic into this video.
+        headless: Do not open any window (for example to only write the mosaic).
+    """
+    MOSAIC_WINDOW = 'Video Streaming Mosaic'
+
+    def __init__(
+        self, queue=None, maxsize=30, start=True, policy='drop_oldest', max_fps=0, mosaic=False,
+        mosaic_size=(1080, 1920), mosaic_fps=15, mosaic_output=None, headless=False
+    ):
+        self.mosaic = MosaicCompositor(mosaic_size) if mosaic else None
+        self.mosaic_fps = mosaic_fps
+        self.mosaic_output = mosaic_output
+        self.mosaic_writer = None
+        self.headless = headless
+        self.max_fps = max_fps
+        self.window_fps = {}  # window_name: max fps
+        self.ready = Event()
+        self.ready_windows = set()
+        self.pending = {}  # window_name: latest image which waits for the fps limit
         self.windows = {}
         self.maxsize = maxsize
+        self.policy = policy
         self.queue = queue
         self.thread = None
         self.stop_signal = {}
+        METRICS.watch('visualizer_queue_depth', self, lambda v: {
+            (('window', k), ): w['q'].qsize() for k, w in list(v.windows.items())})
+        METRICS.watch('visualizer_queue_drops_total', self, lambda v: {
+            (('window', k), ): w['q'].drops for k, w in list(v.windows.items())})
         if start:
             self.run_start()
 
@@ -27,13 +172,10 @@ class Visualizer:
         if self.thread is None:
             return
         for window_name in list(self.windows.keys()):
-            # Check full
-            if self.windows[window_name]['q'].full():
-                self.windows[window_name]['q'].get()
-
             # put stop information to queue
-            self.windows[window_name]['q'].put(None)
+            offer(self.windows[window_name]['q'], None, control=True)
         self.stop_flag = True
+        self.ready.set()
         self.thread.join()
 
     def check_stop(self, window_name):
@@ -45,7 +187,26 @@ class Visualizer:
         # new window information in dict
         if window_name not in self.windows:
             self.stop_signal[window_name] = False
-            self.windows[window_name] = {'q': Queue(self.maxsize), 'start': False}
+            q = ReadyQueue(self.maxsize, policy=self.policy)
+            q.listeners.append(WindowReady(self, window_name))
+            self.windows[window_name] = {'q': q, 'start': False, 'last': 0.0}
+
+    def set_max_fps(self, window_name, fps):
+        """ Limit the FPS of the window (0 is unlimited), the images between two shows are skipped """
+        self.window_fps[window_name] = fps
+
+    @staticmethod
+    def _latest(q):
+        """ Take every image in the queue, return (got, latest image), stop at None (close the window) """
+        got, img = False, None
+        while True:
+            try:
+                img, got = q.get_nowait(), True
+            except Empty:
+                break
+            if img is None:
+                break
+        return got, img
 
     def put_frame(self, window_name, img):
         # Check stop
@@ -55,50 +216,137 @@ class Visualizer:
         # new a window
         self._check_window(window_name)
 
-        # Check full
-        if self.windows[window_name]['q'].full():
-            self.windows[window_name]['q'].get()
-
-        # put new image information
-        self.windows[window_name]['q'].put(img)
+        # put new image information by the queue policy
+        offer(self.windows[window_name]['q'], img)
         return True
 
-    def show_img(self, window_name, img):
-        """ Show image """
-        # new a window
+    def _display(self, window_name, img):
+        """ Show the image or close the window (None), without waitKey """
         self._check_window(window_name)
+        if img is None:
+            self.stop_signal[window_name] = True
+            window = self.windows.pop(window_name)
+            self.pending.pop(window_name, None)
+            if window['start'] and not self.headless:
+                cv2.destroyWindow(window_name)
+            return
+        self.windows[window_name]['last'] = time.time()
+        if self.headless:
+            return
         if not self.windows[window_name]['start']:
             self.windows[window_name]['start'] = True
             cv2.namedWindow(window_name)
+        cv2.imshow(window_name, img)
+
+    def _wait_key(self, window_names):
+        """ One waitKey of the render pass, 'q' closes the windows of the pass """
+        if not self.headless and cv2.waitKey(1) & 0xFF == ord('q'):
+            for window_name in window_names:
+                self._display(window_name, None)
 
-        # waitkey to show image
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            img = None
+    def show_img(self, window_name, img):
+        """ Show image """
+        if self.mosaic is not None:
+            return self.mosaic_img(window_name, img)
+        self._display(window_name, img)
+        self._wait_key([window_name] if img is not None else [])
 
-        # show image or close window
+    def mosaic_img(self, window_name, img):
+        """ Update the tile of the window in the mosaic (None removes it) """
+        self._check_window(window_name)
         if img is None:
             self.stop_signal[window_name] = True
-            self.windows.pop(window_name)
-            cv2.destroyWindow(window_name)
+            self.windows.pop(window_name, None)
+            self.mosaic.remove(window_name)
         else:
-            cv2.imshow(window_name, img)
+            self.mosaic.update(window_name, img)
+
+    def render_mosaic(self):
+        """ Draw the mosaic, show it and write it to mosaic_output """
+        if not len(self.mosaic.names):
+            return
+        canvas = self.mosaic.render()
+        if self.mosaic_output is not None:
+            if self.mosaic_writer is None:
+                self.mosaic_writer = create_encoder(
+                    'opencv', self.mosaic_output, self.mosaic_fps, canvas.shape[1], canvas.shape[0])
+            self.mosaic_writer.write(canvas)
+        if not self.headless:
+            cv2.imshow(Visualizer.MOSAIC_WINDOW, canvas)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                for window_name in list(self.windows.keys()):
+                    self.mosaic_img(window_name, None)
+
+    def show_mosaic(self):
+        """ Show video streaming in the mosaic """
+        interval = 1 / self.mosaic_fps
+        while not (self.stop_flag and all(self.stop_signal)):
+            start = time.time()
+            self.ready.clear()
+            while self.ready_windows:
+                # only the latest image of the window is drawn
+                window_name = self.ready_windows.pop()
+                window = self.windows.get(window_name)
+                if window is None:
+                    continue
+                got, img = Visualizer._latest(window['q'])
+                if got:
+                    self.mosaic_img(window_name, img)
+            # mosaic_output is written at a constant mosaic_fps, otherwise the mosaic is only drawn for new images
+            if self.mosaic.dirty or self.mosaic_output is not None:
+                self.render_mosaic()
+            elif not self.headless:
+                cv2.waitKey(1)
+            # wait for new images, but not render more than mosaic_fps
+            time.sleep(max(0.0, interval - (time.time() - start)))
+            if self.mosaic_output is None:
+                self.ready.wait(timeout=1.0)
+
+        # Stop the process
+        if self.mosaic_writer is not None:
+            self.mosaic_writer.release()
+            self.mosaic_writer = None
+        if not self.headless:
+            cv2.destroyAllWindows()
+            cv2.waitKey(1)
+        logger.info('Stop visualizer thread.')
 
     def show(self):
         """ Show video streaming """
+        if self.mosaic is not None:
+            return self.show_mosaic()
         while not (self.stop_flag and all(self.stop_signal)):
-            # get image information
-            show_window = 0
-            for window_name in list(self.windows.keys()):
-                if not self.windows[window_name]['q'].empty():
-                    img = self.windows[window_name]['q'].get()
-
-                    # new a window to show image
-                    self.show_img(window_name, img)
-                    show_window += 1
-            if show_window == 0:
-                time.sleep(0.1)
+            self.ready.clear()
+            # take the latest image of the ready windows
+            while self.ready_windows:
+                window_name = self.ready_windows.pop()
+                window = self.windows.get(window_name)
+                if window is None:
+                    continue
+                got, img = Visualizer._latest(window['q'])
+                if got:
+                    self.pending[window_name] = img
+
+            # show the images which are not limited by max_fps
+            shown, now, next_due = [], time.time(), None
+            for window_name, img in list(self.pending.items()):
+                fps = self.window_fps.get(window_name, self.max_fps)
+                due = self.windows[window_name]['last'] + 1 / fps if fps and img is not None else now
+                if due <= now:
+                    self.pending.pop(window_name)
+                    self._display(window_name, img)
+                    if img is not None:
+                        shown.append(window_name)
+                else:
+                    next_due = due if next_due is None else min(next_due, due)
+            if len(shown):
+                self._wait_key(shown)
+
+            # sleep until new images or the next due image
+            self.ready.wait(timeout=1.0 if next_due is None else max(0.0, next_due - time.time()))
 
         # Stop the process
-        cv2.destroyAllWindows()
-        cv2.waitKey(1)
+        if not self.headless:
+            cv2.destroyAllWindows()
+            cv2.waitKey(1)
         logger.info('Stop visualizer thread.')